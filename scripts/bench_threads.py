@@ -0,0 +1,146 @@
+"""
+Compares OwlDNS QPS from 1 to N threads.
+
+The "local" workload queries one local record. The "cache" workload queries a
+set of names answered by a stub upstream; they are warmed up before measuring,
+so every query is a hit on the sharded cache that all threads share.
+"""
+from __future__ import annotations
+import argparse
+import itertools
+import multiprocessing
+import os
+import socket
+import time
+from dnslib import DNSRecord, QTYPE, RR, A
+
+HOST = "127.0.0.1"
+
+
+def run_stub(port: int) -> None:
+    """A minimal upstream answering every A query with a long-lived record."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((HOST, port))
+    while True:
+        data, addr = sock.recvfrom(512)
+        reply = DNSRecord.parse(data).reply()
+        reply.add_answer(RR(reply.q.qname, QTYPE.A, ttl=3600, rdata=A("10.0.0.1")))
+        sock.sendto(reply.pack(), addr)
+
+
+def run_server(port: int, threads: int, stub_port: int | None) -> None:
+    """Runs an OwlDNS server answering bench.test locally and forwarding the rest to the stub."""
+    import asyncio
+    import uvloop
+    from owldns import OwlDNSServer
+    upstreams = [{"address": f"udp://{HOST}:{stub_port}", "group": None, "proxy": None}] if stub_port else []
+    server = OwlDNSServer(host=HOST, port=port, records={"bench.test": ["10.0.0.1"]},
+                          upstreams=upstreams, threads=threads, cache={"size": 100_000})
+    asyncio.run(server.start(), loop_factory=uvloop.new_event_loop)
+
+
+def workload_names(workload: str, names: int) -> list[str]:
+    if workload == "cache":
+        return [f"n{index}.cache.bench.test" for index in range(names)]
+    return ["bench.test"]
+
+
+def run_client(port: int, duration: float, window: int, names: list[str], results) -> None:
+    """Keeps `window` queries in flight on one socket, cycling through names, and counts answers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((HOST, port))
+    sock.settimeout(0.2)
+    queries = itertools.cycle([DNSRecord.question(name).pack() for name in names])
+    answered = 0
+    for _ in range(window):
+        sock.send(next(queries))
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        try:
+            sock.recv(512)
+            answered += 1
+        except (socket.timeout, ConnectionRefusedError):
+            # Refill the window after drops
+            for _ in range(window):
+                sock.send(next(queries))
+            continue
+        sock.send(next(queries))
+    sock.close()
+    results.put(answered)
+
+
+def warm_up(port: int, names: list[str]) -> None:
+    """Queries each name once, so the measured run only sees cache hits."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((HOST, port))
+        sock.settimeout(2.0)
+        for name in names:
+            sock.send(DNSRecord.question(name).pack())
+            sock.recv(512)
+
+
+def measure(port: int, threads: int, clients: int, duration: float, window: int,
+            workload: str, names: int) -> float:
+    """Starts a server with `threads` loops and returns the answered QPS."""
+    processes = []
+    stub_port = None
+    if workload == "cache":
+        stub_port = port + 1
+        processes.append(multiprocessing.Process(target=run_stub, args=(stub_port,), daemon=True))
+    processes.append(multiprocessing.Process(target=run_server, args=(port, threads, stub_port),
+                                             daemon=True))
+    for process in processes:
+        process.start()
+    time.sleep(1.0)
+
+    queried = workload_names(workload, names)
+    if workload == "cache":
+        warm_up(port, queried)
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_client,
+                                       args=(port, duration, window, queried, results))
+               for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for process in processes:
+        process.terminate()
+        process.join()
+    return sum(results.get() for _ in workers) / duration
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare OwlDNS QPS from 1 to N threads.")
+    parser.add_argument("--max-threads", type=int, default=os.cpu_count() or 4)
+    # SO_REUSEPORT pins each client socket to one server socket, so use at least
+    # as many clients as threads or some threads will sit idle
+    parser.add_argument("--clients", type=int, default=8, help="Load generator processes")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per run")
+    parser.add_argument("--window", type=int, default=64, help="Queries in flight per client")
+    parser.add_argument("--port", type=int, default=5399, help="Server port (the stub uses port + 1)")
+    parser.add_argument("--workload", choices=["local", "cache", "both"], default="both",
+                        help="Local record lookups, sharded-cache hits, or both")
+    parser.add_argument("--names", type=int, default=1000, help="Distinct names in the cache workload")
+    args = parser.parse_args()
+
+    workloads = ["local", "cache"] if args.workload == "both" else [args.workload]
+    print(f"🚀 Thread scaling benchmark: 1..{args.max_threads} threads, "
+          f"{args.clients} clients x {args.window} in flight, {args.duration}s per run")
+    for workload in workloads:
+        print("-" * 40)
+        print(f"📦 {workload} workload" + (f" ({args.names} names)" if workload == "cache" else ""))
+        baseline = None
+        threads = 1
+        while threads <= args.max_threads:
+            qps = measure(args.port, threads, args.clients, args.duration, args.window,
+                          workload, args.names)
+            baseline = baseline or qps
+            print(f"🧵 {threads:>3} threads: {qps:>10.0f} QPS  ({qps / baseline:.2f}x)")
+            threads *= 2
+    print("-" * 40)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+"""
+Replays a captured query log against OwlDNS backed by a local stub upstream,
+and reports cache hit ratio, latency percentiles and memory growth.
+
+Input is either a pcap file (classic libpcap format; queries to UDP port 53 over
+Ethernet, Linux cooked or raw IP) or JSONL with one query per line:
+
+    {"ts": 1712345678.125, "name": "example.com", "type": "AAAA", "client": "10.0.0.5"}
+
+"type" defaults to A and "client" is optional (sent as an ECS option with --ecs,
+so split-horizon views see it). The stub answers every query deterministically
+(the same name always gets the same address and TTL), so reports from different
+commits replaying the same log are comparable; each report records the git
+commit and a hash of the input. Save one with --output and diff a later run
+against it with --compare.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+import zlib
+from dnslib import DNSRecord, EDNS0, EDNSOption, QTYPE, RCODE, RR, A, AAAA
+from owldns.upstream import question_section
+
+HOST = "127.0.0.1"
+
+# Link-layer header lengths per pcap link type (the IP version is read from the packet)
+LINK_HEADERS = {0: 4, 1: 14, 12: 0, 14: 0, 101: 0, 113: 16, 276: 20}
+
+
+def read_jsonl(path: str):
+    """Yields (timestamp, name, qtype, client) from a JSONL query log."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield (float(entry.get("ts", 0.0)), entry["name"],
+                       getattr(QTYPE, entry.get("type", "A").upper()), entry.get("client"))
+
+
+def read_pcap(path: str, port: int = 53):
+    """Yields (timestamp, name, qtype, client) for every DNS query to UDP `port` in a pcap file."""
+    with open(path, "rb") as f:
+        header = f.read(24)
+        magic = header[:4]
+        if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+            endian = "<"
+        elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+            endian = ">"
+        else:
+            raise ValueError(f"{path} is not a pcap file (pcapng is not supported)")
+        fraction = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e-6
+        link_type = struct.unpack(endian + "I", header[20:24])[0] & 0xFFFF
+        if link_type not in LINK_HEADERS:
+            raise ValueError(f"Unsupported pcap link type {link_type}")
+        record = struct.Struct(endian + "IIII")
+
+        while len(head := f.read(16)) == 16:
+            seconds, fractional, captured, _ = record.unpack(head)
+            frame = f.read(captured)
+            offset = LINK_HEADERS[link_type]
+            if link_type == 1:
+                # Skip 802.1Q VLAN tags
+                while frame[offset - 2:offset] == b"\x81\x00":
+                    offset += 4
+            packet = frame[offset:]
+            if not packet:
+                continue
+
+            version = packet[0] >> 4
+            if version == 4 and packet[9] == 17:
+                client = socket.inet_ntop(socket.AF_INET, packet[12:16])
+                udp = packet[(packet[0] & 0x0F) * 4:]
+            elif version == 6 and packet[6] == 17:
+                client = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+                udp = packet[40:]
+            else:
+                continue
+            if len(udp) < 8 or struct.unpack("!H", udp[2:4])[0] != port:
+                continue
+            try:
+                message = DNSRecord.parse(udp[8:])
+            except Exception:
+                continue
+            if message.header.qr or not message.questions:
+                continue
+            yield (seconds + fractional * fraction, str(message.q.qname).rstrip("."),
+                   message.q.qtype, client)
+
+
+def load_queries(path: str, limit: int | None = None) -> list[tuple[float, str, int, str | None]]:
+    """Reads a pcap or JSONL log, sorted by time and rebased to start at 0."""
+    with open(path, "rb") as f:
+        is_pcap = f.read(4) in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1",
+                                b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d")
+    queries = list(read_pcap(path) if is_pcap else read_jsonl(path))
+    queries.sort(key=lambda q: q[0])
+    if limit:
+        queries = queries[:limit]
+    start = queries[0][0] if queries else 0.0
+    return [(ts - start, name, qtype, client) for ts, name, qtype, client in queries]
+
+
+class StubUpstream(asyncio.DatagramProtocol):
+    """
+    A deterministic upstream: A/AAAA queries get an address derived from the
+    name, names starting with "nx" get NXDOMAIN, everything else NODATA.
+    """
+
+    def __init__(self, ttl: int, delay: float):
+        self.ttl = ttl
+        self.delay = delay
+        self.queries = 0
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        self.queries += 1
+        reply = self.answer(DNSRecord.parse(data))
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, reply, addr)
+        else:
+            self.transport.sendto(reply, addr)
+
+    def answer(self, request: DNSRecord) -> bytes:
+        name = str(request.q.qname)
+        reply = request.reply()
+        seed = zlib.crc32(name.lower().encode())
+        if name.startswith("nx"):
+            reply.header.rcode = RCODE.NXDOMAIN
+        elif request.q.qtype == QTYPE.A:
+            reply.add_answer(RR(name, QTYPE.A, ttl=self.ttl,
+                                rdata=A(socket.inet_ntoa(struct.pack("!I", 0x0A000000 | seed & 0xFFFFFF)))))
+        elif request.q.qtype == QTYPE.AAAA:
+            reply.add_answer(RR(name, QTYPE.AAAA, ttl=self.ttl,
+                                rdata=AAAA(socket.inet_ntop(socket.AF_INET6, b"\xfd" + bytes(11)
+                                                            + seed.to_bytes(4, "big")))))
+        if not reply.rr:
+            # Negative answers carry an SOA so they are cacheable (RFC 2308)
+            reply.add_auth(*RR.fromZone(f". {self.ttl} IN SOA ns.stub. admin.stub. 1 3600 600 86400 {self.ttl}"))
+        return reply.pack()
+
+
+class ReplayClient(asyncio.DatagramProtocol):
+    """
+    Sends queries over one socket and records per-query latency. Outstanding
+    queries are keyed by (transaction ID, question) and an ID is never reused
+    while its question is still in flight, so a late answer is not credited
+    to a newer query once IDs wrap around.
+    """
+
+    def __init__(self):
+        self.sent: dict[tuple[int, bytes], float] = {}
+        self.latencies: list[float] = []
+        self.queries = 0
+        self.next_id = 0
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        try:
+            key = (struct.unpack("!H", data[:2])[0], question_section(data))
+        except (ValueError, struct.error):
+            return
+        started = self.sent.pop(key, None)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+
+    def send(self, data: bytes) -> None:
+        """Sends a packed query under the next transaction ID not in flight for its question."""
+        question = bytes(question_section(data))
+        query_id = self.next_id
+        while (query_id, question) in self.sent:
+            query_id = (query_id + 1) & 0xFFFF
+        self.next_id = (query_id + 1) & 0xFFFF
+        self.sent[(query_id, question)] = time.perf_counter()
+        self.queries += 1
+        self.transport.sendto(query_id.to_bytes(2, "big") + data[2:])
+
+    def expire(self, timeout: float) -> None:
+        """Gives up on queries unanswered for `timeout` seconds; their late answers are ignored."""
+        expired = time.perf_counter() - timeout
+        for key in [k for k, sent_at in self.sent.items() if sent_at < expired]:
+            del self.sent[key]
+
+    async def wait_for_window(self, window: int, timeout: float) -> None:
+        """Waits until fewer than `window` queries are outstanding, giving up on lost ones."""
+        while len(self.sent) >= window:
+            await asyncio.sleep(0.0005)
+            self.expire(timeout)
+
+
+def rss_kib(pid: int) -> int | None:
+    """Resident set size of a process in KiB (Linux), or None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_server(port: int, config_run: dict) -> None:
+    """Runs OwlDNS from a [run] config section (in a child process)."""
+    import uvloop
+    from owldns.cli import build_server
+    server = build_server(HOST, port, config_run)
+    asyncio.run(server.start(), loop_factory=uvloop.new_event_loop)
+
+
+def server_config(args: argparse.Namespace, stub_port: int, admin_socket: str) -> dict:
+    """The [run] section to replay against, with every upstream pointed at the stub."""
+    config_run: dict = {"hosts_file": os.devnull}
+    if args.config:
+        from owldns.utils import load_config
+        config_run = {**config_run, **load_config(args.config).get("run", {})}
+    stub = f"udp://{HOST}:{stub_port}"
+    upstreams = config_run.get("upstream") or [{"address": stub, "group": None, "proxy": None}]
+    config_run["upstream"] = [{**u, "address": stub, "proxy": None} for u in upstreams]
+    config_run["admin"] = {"socket": admin_socket}
+    config_run["listen"] = None
+    config_run["debug"] = False
+    if args.ecs:
+        # The replay client stands in for a front-end resolver, so trust its ECS
+        config_run["ecs_trusted"] = [*config_run.get("ecs_trusted", []), f"{HOST}/32"]
+    if args.cache_size is not None:
+        config_run["cache"] = {**config_run.get("cache", {}), "size": args.cache_size}
+    return config_run
+
+
+async def replay(args: argparse.Namespace, queries: list) -> dict:
+    from owldns.admin import admin_request
+    loop = asyncio.get_running_loop()
+    stub_transport, stub = await loop.create_datagram_endpoint(
+        lambda: StubUpstream(args.stub_ttl, args.stub_delay / 1000), local_addr=(HOST, 0))
+    stub_port = stub_transport.get_extra_info("sockname")[1]
+
+    workdir = tempfile.mkdtemp(prefix="owldns-replay-")
+    admin = {"socket": os.path.join(workdir, "admin.sock")}
+    # Spawn rather than fork: this process already runs an event loop
+    server = multiprocessing.get_context("spawn").Process(
+        target=run_server, args=(args.port, server_config(args, stub_port, admin["socket"])),
+        daemon=True)
+    server.start()
+    for _ in range(100):
+        if os.path.exists(admin["socket"]):
+            break
+        await asyncio.sleep(0.05)
+    else:
+        server.terminate()
+        raise RuntimeError("OwlDNS did not start")
+
+    client_transport, client = await loop.create_datagram_endpoint(
+        ReplayClient, remote_addr=(HOST, args.port))
+    timeline = []
+    baseline_rss = rss_kib(server.pid)
+
+    async def sample(elapsed: float) -> None:
+        stats = (await admin_request(admin, "stats"))["cache"]
+        timeline.append({"t": round(elapsed, 2), "sent": client.queries, "answered": len(client.latencies),
+                         "cache_entries": stats["entries"], "hit_ratio": stats["hit_ratio"],
+                         "rss_kib": rss_kib(server.pid)})
+
+    async def sample_periodically() -> None:
+        # Runs on its own schedule, so gaps in the log still produce samples
+        next_sample = start + args.interval
+        while True:
+            await asyncio.sleep(max(0.0, next_sample - time.perf_counter()))
+            client.expire(args.timeout)
+            await sample(time.perf_counter() - start)
+            next_sample += args.interval
+
+    start = time.perf_counter()
+    sampler = asyncio.create_task(sample_periodically())
+    try:
+        for ts, name, qtype, client_ip in queries:
+            request = DNSRecord.question(name, QTYPE.get(qtype))
+            if args.ecs and client_ip:
+                family, bits = (2, 128) if ":" in client_ip else (1, 32)
+                packed = socket.inet_pton(socket.AF_INET6 if family == 2 else socket.AF_INET, client_ip)
+                request.add_ar(EDNS0(opts=[EDNSOption(8, struct.pack("!HBB", family, bits, 0) + packed)]))
+            if args.speed:
+                delay = start + ts / args.speed - time.perf_counter()
+                if delay > 0.001:
+                    await asyncio.sleep(delay)
+            else:
+                # Unpaced: keep at most `window` queries in flight
+                await client.wait_for_window(args.window, args.timeout)
+            client.send(request.pack())
+
+        # Give the tail of the log time to be answered
+        deadline = time.perf_counter() + args.timeout
+        while client.sent and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        duration = time.perf_counter() - start
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+        await sample(duration)
+        stats = (await admin_request(admin, "stats"))["cache"]
+    finally:
+        sampler.cancel()
+        client_transport.close()
+        server.terminate()
+        server.join()
+        stub_transport.close()
+
+    latencies = sorted(client.latencies)
+
+    def percentile(fraction: float) -> float | None:
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 3)
+
+    final_rss = timeline[-1]["rss_kib"]
+    return {
+        "queries": len(queries),
+        "answered": len(latencies),
+        "lost": len(queries) - len(latencies),
+        "duration_s": round(duration, 3),
+        "qps": round(len(latencies) / duration, 1) if duration else None,
+        "cache_hit_ratio": stats["hit_ratio"],
+        "upstream_queries": stub.queries,
+        # Share of queries answered without reaching the upstream (cache, local records, policy)
+        "offload_ratio": round(1 - stub.queries / len(queries), 4) if queries else None,
+        "latency_ms": {"p50": percentile(0.50), "p90": percentile(0.90), "p99": percentile(0.99),
+                       "p999": percentile(0.999), "max": percentile(1.0)},
+        "rss_kib": {"start": baseline_rss, "end": final_rss,
+                    "growth": final_rss - baseline_rss if final_rss and baseline_rss else None},
+        "timeline": timeline,
+    }
+
+
+def environment(args: argparse.Namespace) -> dict:
+    """What a run was measured against, so reports from different commits can be lined up."""
+    def git(*cmd: str) -> str:
+        try:
+            return subprocess.run(["git", *cmd], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    with open(args.log, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    return {
+        "commit": git("rev-parse", "--short", "HEAD") + ("-dirty" if git("status", "--porcelain", "-uno") else ""),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "log": os.path.basename(args.log),
+        "log_sha256": digest,
+        "speed": args.speed,
+        "stub_ttl": args.stub_ttl,
+        "stub_delay_ms": args.stub_delay,
+        "config": args.config,
+    }
+
+
+def print_report(report: dict, baseline: dict | None = None) -> None:
+    env, result = report["env"], report["result"]
+    print(f"🎞️  Replay of {env['log']} ({result['queries']} queries) at commit {env['commit'] or '?'}")
+    print("-" * 60)
+    rows = [
+        ("answered", result["answered"], ""), ("lost", result["lost"], ""),
+        ("qps", result["qps"], ""), ("cache hit ratio", result["cache_hit_ratio"], ""),
+        ("offload ratio", result["offload_ratio"], ""),
+        *((f"latency {k}", v, "ms") for k, v in result["latency_ms"].items()),
+        ("rss growth", result["rss_kib"]["growth"], "KiB"),
+    ]
+    old = {}
+    if baseline:
+        b = baseline["result"]
+        old = {"answered": b["answered"], "lost": b["lost"], "qps": b["qps"],
+               "cache hit ratio": b["cache_hit_ratio"], "offload ratio": b["offload_ratio"],
+               **{f"latency {k}": v for k, v in b["latency_ms"].items()},
+               "rss growth": b["rss_kib"]["growth"]}
+        print(f"{'':<18} {'this run':>12} {baseline['env']['commit'] or 'baseline':>12} {'change':>9}")
+    for label, value, unit in rows:
+        line = f"{label:<18} {value if value is not None else 'n/a':>12}"
+        if baseline:
+            before = old.get(label)
+            line += f" {before if before is not None else 'n/a':>12}"
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                line += f" {(value - before) / before:>+8.1%}"
+        print(f"{line} {unit}".rstrip())
+    print("-" * 60)
+    if baseline and baseline["env"]["log_sha256"] != env["log_sha256"]:
+        print("⚠️  The baseline replayed a different log; the numbers are not comparable.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a captured query log against OwlDNS.")
+    parser.add_argument("log", help="pcap file or JSONL query log")
+    parser.add_argument("--config", help="OwlDNS TOML config whose [run] section to use "
+                                         "(records, views, cache, policy); upstreams are replaced by the stub")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Timing scale (2 = twice as fast as captured, 0 = as fast as possible)")
+    parser.add_argument("--window", type=int, default=256, help="Queries in flight when --speed 0")
+    parser.add_argument("--limit", type=int, help="Replay only the first N queries")
+    parser.add_argument("--cache-size", type=int, help="Override [run.cache] size")
+    parser.add_argument("--ecs", action="store_true", help="Send each query's client address as ECS")
+    parser.add_argument("--stub-ttl", type=int, default=300, help="TTL of stub answers")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="Stub upstream delay in ms")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Seconds to wait for late answers")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between timeline samples")
+    parser.add_argument("--port", type=int, default=5398)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="A previous JSON report to compare against")
+    args = parser.parse_args()
+
+    import uvloop
+    queries = load_queries(args.log, args.limit)
+    if not queries:
+        parser.error(f"No queries found in {args.log}")
+    result = asyncio.run(replay(args, queries), loop_factory=uvloop.new_event_loop)
+    report = {"env": environment(args), "result": result}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+from __future__ import annotations
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+from owldns.profiling import LatencyHistograms
+from owldns.resolver import Resolver
+from owldns.types import AdminConfig
+from owldns.utils import logger, redact_proxy
+
+
+def parse_admin_address(address: str) -> tuple[str, int]:
+    """Splits a "host:port" admin address, refusing hosts that are not loopback."""
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"Invalid admin address: {address}")
+    host = host.strip("[]")
+    if host != "localhost" and not ipaddress.ip_address(host).is_loopback:
+        raise ValueError(f"Admin address must be a loopback address: {address}")
+    return host, int(port)
+
+
+class AdminServer:
+    """
+    Local admin endpoint for changing a running server without a restart.
+    Clients send one JSON object per line ({"command": ..., ...}) and get one
+    JSON object back per line ({"ok": true, ...} or {"ok": false, "error": ...}).
+    Every command is a constant-time (or O(labels)) update on the event loop:
+    cache flushes record markers instead of scanning, and records are changed
+    in place in the lookup indexes.
+    """
+
+    def __init__(self, resolver: Resolver, config: AdminConfig,
+                 profiler: LatencyHistograms | None = None):
+        self.resolver: Resolver = resolver
+        self.config: AdminConfig = config
+        self.profiler: LatencyHistograms | None = profiler
+        self.server: asyncio.AbstractServer | None = None
+        self.commands = {
+            "flush": self.flush,
+            "add_record": self.add_record,
+            "remove_record": self.remove_record,
+            "stats": self.stats,
+            "upstreams": self.upstreams,
+            "log_level": self.log_level,
+        }
+
+    async def start(self) -> None:
+        """Starts listening on the configured Unix socket or loopback address."""
+        path = self.config.get("socket")
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self.handle_client, path=path)
+            os.chmod(path, 0o600)
+            logger.info("Admin API listening on %s", path)
+        else:
+            host, port = parse_admin_address(self.config.get("address", "127.0.0.1:5380"))
+            self.server = await asyncio.start_server(self.handle_client, host, port)
+            logger.info("Admin API listening on %s:%d", host, port)
+
+    def close(self) -> None:
+        if self.server:
+            self.server.close()
+            self.server = None
+            if self.config.get("socket") and os.path.exists(self.config["socket"]):
+                os.unlink(self.config["socket"])
+
+    async def handle_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        """Answers newline-delimited JSON requests until the client disconnects."""
+        try:
+            # readline() raises ValueError past the stream limit (64 KiB)
+            while line := await reader.readline():
+                writer.write(json.dumps(self.dispatch(line)).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def dispatch(self, line: bytes) -> dict:
+        """Runs one request line and returns the reply object."""
+        try:
+            request = json.loads(line)
+            handler = self.commands.get(request.pop("command", None))
+            if handler is None:
+                raise ValueError(f"Unknown command; expected one of: {', '.join(self.commands)}")
+            return {"ok": True, **handler(**request)}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    def flush(self, name: str | None = None, suffix: str | None = None) -> dict:
+        """Flushes a name, a suffix and its subdomains, or (no arguments) the whole cache."""
+        self.resolver.cache.flush(name, suffix)
+        logger.info("Admin: flushed cache (name=%s, suffix=%s)", name, suffix)
+        return {}
+
+    def add_record(self, name: str, ip: str, view: str | None = None) -> dict:
+        ipaddress.ip_address(ip)
+        self.resolver.add_record(name.rstrip("."), ip, view)
+        logger.info("Admin: added record %s -> %s (view=%s)", name, ip, view)
+        return {}
+
+    def remove_record(self, name: str, ip: str | None = None, view: str | None = None) -> dict:
+        removed = self.resolver.remove_record(name.rstrip("."), ip, view)
+        logger.info("Admin: removed record %s %s (view=%s): %s", name, ip or "*", view, removed)
+        return {"removed": removed}
+
+    def stats(self) -> dict:
+        cache = self.resolver.cache
+        lookups = cache.hits + cache.misses
+        reply: dict = {"cache": {
+            "entries": len(cache),
+            "size": cache.size,
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "hit_ratio": round(cache.hits / lookups, 4) if lookups else None,
+        }}
+        if self.profiler:
+            reply["latency"] = self.profiler.summary()
+        return reply
+
+    def upstreams(self) -> dict:
+        health = self.resolver.merged_health()
+        return {"upstreams": [
+            {"address": u["address"], "group": u["group"], "proxy": redact_proxy(u["proxy"]),
+             **(health[u["address"]].as_dict() if u["address"] in health else {})}
+            for u in self.resolver.upstreams if u["address"]
+        ]}
+
+    def log_level(self, level: str) -> dict:
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError(f"Unknown log level: {level}")
+        logger.setLevel(value)
+        logger.info("Admin: log level set to %s", level.upper())
+        return {"level": level.upper()}
+
+
+async def admin_request(config: AdminConfig, command: str, **args) -> dict:
+    """Client side: sends one command to a running server's admin endpoint."""
+    if config.get("socket"):
+        reader, writer = await asyncio.open_unix_connection(config["socket"])
+    else:
+        reader, writer = await asyncio.open_connection(
+            *parse_admin_address(config.get("address", "127.0.0.1:5380")))
+    try:
+        writer.write(json.dumps({"command": command, **args}).encode() + b"\n")
+        await writer.drain()
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
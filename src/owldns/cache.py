@@ -0,0 +1,319 @@
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dnslib import DNSRecord, QTYPE, RCODE
+from owldns.index import SuffixIndex, normalize_name
+from owldns.types import CacheConfig
+from owldns.utils import logger
+
+# Cache key: (view name, normalized qname, qtype)
+CacheKey = tuple[str, str, int]
+
+# Snapshot row: (view, qname, qtype, rcode, age, remaining TTL, packed response as hex)
+SnapshotRow = tuple[str, str, int, int, float, float, str]
+
+
+class CacheEntry:
+    """A cached response and the monotonic times it was stored and expires at."""
+    __slots__ = ("packed", "stored", "expires", "rcode")
+
+    def __init__(self, packed: bytes, stored: float, expires: float, rcode: int):
+        self.packed = packed
+        self.stored = stored
+        self.expires = expires
+        self.rcode = rcode
+
+
+def response_ttl(response: DNSRecord, config: CacheConfig) -> int | None:
+    """
+    Returns how long a response may be cached, or None if it must not be.
+    Positive answers live for their smallest answer TTL. NXDOMAIN and NODATA
+    answers are cached per RFC 2308: min(SOA TTL, SOA MINIMUM) from the authority section.
+    """
+    rcode = response.header.rcode
+    if rcode == RCODE.NOERROR and response.rr:
+        ttl = min(rr.ttl for rr in response.rr)
+        return max(config.get("min_ttl", 0), min(ttl, config.get("max_ttl", 86400)))
+
+    if rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+        for rr in response.auth:
+            if rr.rtype == QTYPE.SOA:
+                ttl = min(rr.ttl, rr.rdata.times[-1])
+                return min(ttl, config.get("negative_max_ttl", 3600))
+    return None
+
+
+class DNSCache:
+    """
+    LRU response cache keyed by (view, qname, qtype).
+    Entries keep the packed upstream response; hits are re-stamped with the
+    client's transaction ID and question, and their TTLs are aged.
+    """
+
+    def __init__(self, config: CacheConfig | None = None):
+        self.config: CacheConfig = config or {}
+        self.size: int = self.config.get("size", 10000)
+        self.entries: OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        # Names known not to exist, keyed by (view, qname), for any-qtype denial
+        self.nxdomains: OrderedDict[tuple[str, str], CacheEntry] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        # Flush markers: entries stored at or before the marker time are stale.
+        # Flushing only records a marker (O(1)); stale entries are dropped when next read.
+        self.flushed_names: dict[str, float] = {}
+        self.flushed_suffixes: SuffixIndex[float] = SuffixIndex()
+
+    def is_flushed(self, name: str, stored: float) -> bool:
+        """Tells whether an entry for name stored at `stored` predates a flush."""
+        flushed = self.flushed_names.get(name)
+        if flushed is not None and stored <= flushed:
+            return True
+        return any(stored <= flushed for flushed in self.flushed_suffixes.match_all(name))
+
+    def get_entry(self, key: CacheKey, now: float | None = None) -> CacheEntry | None:
+        """Returns the live entry for key, dropping it if it has expired or was flushed."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if (entry.expires <= (now if now is not None else time.monotonic())
+                or (self.flushed_names or self.flushed_suffixes) and self.is_flushed(key[1], entry.stored)):
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def flush(self, name: str | None = None, suffix: str | None = None) -> None:
+        """
+        Invalidates the answers for one name, for a suffix and everything below
+        it, or (with no arguments) the whole cache. Applies to all views.
+        """
+        now = time.monotonic()
+        if name is None and suffix is None:
+            self.entries.clear()
+            self.nxdomains.clear()
+            self.flushed_names.clear()
+            self.flushed_suffixes = SuffixIndex()
+            return
+
+        # Markers older than the longest TTL can no longer match a live entry
+        horizon = now - max(self.config.get("max_ttl", 86400), self.config.get("negative_max_ttl", 3600),
+                            self.config.get("min_ttl", 0))
+        self.flushed_names = {n: t for n, t in self.flushed_names.items() if t > horizon}
+        if any(t <= horizon for _, t in self.flushed_suffixes.items()):
+            self.flushed_suffixes = SuffixIndex(
+                {n: t for n, t in self.flushed_suffixes.items() if t > horizon})
+
+        if name is not None:
+            self.flushed_names[normalize_name(name)] = now
+        if suffix is not None:
+            self.flushed_suffixes.add(suffix, now)
+
+    def get(self, key: CacheKey, request: DNSRecord) -> bytes | None:
+        """Returns the cached answer for request, or None on a miss."""
+        now = time.monotonic()
+        entry = self.lookup(key, now)
+        return self.render(entry, request, now) if entry is not None else None
+
+    def lookup(self, key: CacheKey, now: float) -> CacheEntry | None:
+        """Returns the live entry for key, counting the hit or miss."""
+        entry = self.get_entry(key, now)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def get_nxdomain(self, view: str, qname: str, request: DNSRecord,
+                     aggressive: bool = False) -> bytes | None:
+        """
+        Answers from a cached NXDOMAIN for qname, whatever the qtype (RFC 2308 section 5).
+        With aggressive set, a cached NXDOMAIN for any ancestor of qname also
+        answers (RFC 8020): nothing can exist below a name that does not exist.
+        """
+        now = time.monotonic()
+        entry = self.lookup_nxdomain(view, qname, now, aggressive)
+        return self.render(entry, request, now) if entry is not None else None
+
+    def lookup_nxdomain(self, view: str, qname: str, now: float,
+                        aggressive: bool = False) -> CacheEntry | None:
+        """Returns the live NXDOMAIN entry answering qname (see get_nxdomain), counting a hit."""
+        name = qname
+        while True:
+            entry = self.nxdomains.get((view, name))
+            if entry is not None:
+                if entry.expires > now and not (
+                        (self.flushed_names or self.flushed_suffixes) and self.is_flushed(name, entry.stored)):
+                    self.hits += 1
+                    return entry
+                del self.nxdomains[(view, name)]
+            dot = name.find(".")
+            if not aggressive or dot < 0:
+                return None
+            name = name[dot + 1:]
+
+    @staticmethod
+    def render(entry: CacheEntry, request: DNSRecord, now: float) -> bytes:
+        """Rebuilds a cached response for request with TTLs reduced by its age."""
+        response = DNSRecord.parse(entry.packed)
+        response.header.id = request.header.id
+        response.header.rd = request.header.rd
+        response.questions = request.questions
+        age = int(now - entry.stored)
+        if age:
+            for rr in (*response.rr, *response.auth, *response.ar):
+                if rr.rtype != QTYPE.OPT:
+                    rr.ttl = max(0, rr.ttl - age)
+        return response.pack()
+
+    def put(self, key: CacheKey, response: DNSRecord, packed: bytes) -> None:
+        """Caches a response if it is cacheable, evicting the least recently used entry."""
+        ttl = response_ttl(response, self.config)
+        if not ttl or response.header.tc:
+            return
+        now = time.monotonic()
+        self.insert(key, CacheEntry(bytes(packed), now, now + ttl, response.header.rcode))
+
+    def insert(self, key: CacheKey, entry: CacheEntry) -> None:
+        """Stores an entry (and its NXDOMAIN marker), evicting the least recently used."""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        if entry.rcode == RCODE.NXDOMAIN:
+            self.nxdomains[key[:2]] = entry
+            self.nxdomains.move_to_end(key[:2])
+            while len(self.nxdomains) > self.size:
+                self.nxdomains.popitem(last=False)
+
+    def dump(self) -> list[SnapshotRow]:
+        """Returns the live entries, least recently used first, as snapshot rows."""
+        now = time.monotonic()
+        return [(*key, entry.rcode, now - entry.stored, entry.expires - now, entry.packed.hex())
+                for key, entry in self.entries.items() if entry.expires > now]
+
+    def restore(self, rows: list[SnapshotRow], elapsed: float = 0.0) -> int:
+        """Re-inserts snapshot rows taken `elapsed` seconds ago. Returns how many were still live."""
+        now = time.monotonic()
+        restored = 0
+        for view, name, qtype, rcode, age, remaining, packed in rows:
+            if remaining > elapsed:
+                self.insert((view, name, qtype), CacheEntry(
+                    bytes.fromhex(packed), now - age - elapsed, now + remaining - elapsed, rcode))
+                restored += 1
+        return restored
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class ShardedDNSCache:
+    """
+    A thread-safe cache for the multi-threaded server: N independent DNSCache
+    shards, each behind its own lock. Keys are spread by hash of (view, qname),
+    so all qtypes and the NXDOMAIN marker of a name share a shard, and threads
+    only contend when they touch names in the same shard.
+    """
+
+    def __init__(self, config: CacheConfig | None = None, shards: int = 16):
+        self.config: CacheConfig = config or {}
+        self.size: int = self.config.get("size", 10000)
+        shard_config: CacheConfig = {**self.config, "size": max(1, -(-self.size // shards))}
+        self.shards: list[DNSCache] = [DNSCache(shard_config) for _ in range(shards)]
+        self.locks: list[threading.Lock] = [threading.Lock() for _ in range(shards)]
+
+    def _shard(self, view: str, name: str) -> int:
+        return hash((view, name)) % len(self.shards)
+
+    # Only the lookup and LRU touch hold the shard lock; rendering (a parse and
+    # a pack) works on the entry's immutable bytes, so it runs outside it.
+    def get(self, key: CacheKey, request: DNSRecord) -> bytes | None:
+        index = self._shard(key[0], key[1])
+        now = time.monotonic()
+        with self.locks[index]:
+            entry = self.shards[index].lookup(key, now)
+        return DNSCache.render(entry, request, now) if entry is not None else None
+
+    def get_nxdomain(self, view: str, qname: str, request: DNSRecord,
+                     aggressive: bool = False) -> bytes | None:
+        name = qname
+        now = time.monotonic()
+        while True:
+            index = self._shard(view, name)
+            with self.locks[index]:
+                entry = self.shards[index].lookup_nxdomain(view, name, now)
+            if entry is not None:
+                return DNSCache.render(entry, request, now)
+            dot = name.find(".")
+            if not aggressive or dot < 0:
+                return None
+            name = name[dot + 1:]
+
+    def put(self, key: CacheKey, response: DNSRecord, packed: bytes) -> None:
+        index = self._shard(key[0], key[1])
+        with self.locks[index]:
+            self.shards[index].put(key, response, packed)
+
+    def flush(self, name: str | None = None, suffix: str | None = None) -> None:
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.flush(name, suffix)
+
+    def dump(self) -> list[SnapshotRow]:
+        rows: list[SnapshotRow] = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                rows.extend(shard.dump())
+        return rows
+
+    def restore(self, rows: list[SnapshotRow], elapsed: float = 0.0) -> int:
+        by_shard: list[list[SnapshotRow]] = [[] for _ in self.shards]
+        for row in rows:
+            by_shard[self._shard(row[0], row[1])].append(row)
+        restored = 0
+        for shard, lock, shard_rows in zip(self.shards, self.locks, by_shard):
+            with lock:
+                restored += shard.restore(shard_rows, elapsed)
+        return restored
+
+    @property
+    def hits(self) -> int:
+        return sum(shard.hits for shard in self.shards)
+
+    @property
+    def misses(self) -> int:
+        return sum(shard.misses for shard in self.shards)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+
+def save_snapshot(cache: DNSCache | ShardedDNSCache, path: str) -> int:
+    """
+    Writes the live cache entries to path (atomically, via a temporary file).
+    Ages are stored relative to the wall clock, so a restore after a restart
+    ages every entry by the downtime. Returns the number of entries written.
+    """
+    rows = cache.dump()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"saved_at": time.time(), "entries": rows}, f)
+    os.replace(tmp, path)
+    return len(rows)
+
+
+def load_snapshot(cache: DNSCache | ShardedDNSCache, path: str) -> int:
+    """Restores a snapshot written by save_snapshot. Returns the number of live entries loaded."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        elapsed = max(0.0, time.time() - data["saved_at"])
+        return cache.restore(data["entries"], elapsed)
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        logger.error("Error loading cache snapshot %s: %s", path, e)
+        return 0
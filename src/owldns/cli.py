@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import shutil
 import subprocess
@@ -10,10 +11,12 @@ import uvloop
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from owldns.admin import admin_request
 from owldns.server import OwlDNSServer
 from owldns.utils import load_hosts, load_config
 from owldns import setup_logger, logger
 from owldns.config import config as owl_config, update_config
+from owldns.profiling import StackSampler
 
 
 def run_tests() -> None:
@@ -35,14 +38,38 @@ def run_tests() -> None:
         sys.exit(1)
 
 
-def start_server(host: str, port: int, upstreams: list[str], hosts_file: str) -> None:
-    """Initializes and runs the DNS server."""
-    # Load records from the specified hosts file
-    records = load_hosts(hosts_file)
+def build_server(host: str, port: int, config_run: dict, profile: bool = False) -> OwlDNSServer:
+    """Builds the DNS server from the [run] config section."""
+    upstreams = config_run.get(
+        "upstream", [{"address": "1.1.1.1", "group": None, "proxy": None}])
 
-    # Initialize and run the server
-    server = OwlDNSServer(host=host, port=port,
-                          records=records, upstreams=upstreams)
+    # Load records from the specified hosts file
+    records = load_hosts(config_run.get("hosts_file", "/etc/hosts"))
+
+    # Each split-horizon view may bring its own hosts file
+    views = config_run.get("views", [])
+    for view in views:
+        if view.get("hosts_file"):
+            view["records"] = {**load_hosts(view["hosts_file"]), **view.get("records", {})}
+
+    return OwlDNSServer(host=host, port=port, records=records, upstreams=upstreams,
+                        groups=config_run.get("groups", {}), views=views,
+                        cache=config_run.get("cache", {}),
+                        nxdomain=config_run.get("nxdomain", []),
+                        policy=config_run.get("policy", {}),
+                        minimal_responses=config_run.get("minimal_responses", False),
+                        profile=profile or config_run.get("profile", False),
+                        threads=config_run.get("threads", 1),
+                        admin=config_run.get("admin"),
+                        drain_timeout=config_run.get("drain_timeout", 5.0),
+                        listen=config_run.get("listen"),
+                        dns0x20=config_run.get("dns0x20", False),
+                        ecs_trusted=config_run.get("ecs_trusted", []))
+
+
+def start_server(host: str, port: int, config_run: dict) -> None:
+    """Initializes and runs the DNS server."""
+    server = build_server(host, port, config_run)
 
     try:
         asyncio.run(server.start(), loop_factory=uvloop.new_event_loop)
@@ -52,6 +79,31 @@ def start_server(host: str, port: int, upstreams: list[str], hosts_file: str) ->
         logger.error("Error: %s", e)
 
 
+def profile_server(host: str, port: int, config_run: dict, seconds: float,
+                   output: str, interval: float) -> None:
+    """Runs the server under the sampling profiler for a fixed time, then writes the stacks."""
+    server = build_server(host, port, config_run, profile=True)
+    sampler = StackSampler(interval)
+
+    async def run_for() -> None:
+        try:
+            await asyncio.wait_for(server.start(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    sampler.start()
+    try:
+        asyncio.run(run_for(), loop_factory=uvloop.new_event_loop)
+    except KeyboardInterrupt:
+        logger.info("Profiling interrupted.")
+    finally:
+        sampler.stop()
+
+    # The server logs its stage histograms when it shuts down
+    sampler.write(output)
+    logger.info("Wrote %d stack samples to %s", sum(sampler.samples.values()), output)
+
+
 def run_reloader(ctx_args: list[str]) -> None:
     """Starts a watchdog observer to restart the process on file changes."""
     class ReloadHandler(FileSystemEventHandler):
@@ -160,14 +212,14 @@ def run(ctx: click.Context, host: str | None, port: int | None) -> None:
     # Use global config (owl_config) as the source of truth
     config_run = owl_config.get("run", {})
 
+    # An explicit --host replaces the configured listen addresses
+    if host:
+        config_run = {**config_run, "listen": None}
+
     # Priority: CLI argument > TOML config > Hardcoded default
     host = host or config_run.get("host", "127.0.0.1")
     port = port or config_run.get("port", 5353)
 
-    upstreams = config_run.get(
-        "upstream", [{"address": "1.1.1.1", "group": None, "proxy": None}])
-
-    hosts_file = config_run.get("hosts_file", "/etc/hosts")
     debug = config_run.get("debug", False)
 
     log_level = ctx.obj['log_level']
@@ -182,7 +234,61 @@ def run(ctx: click.Context, host: str | None, port: int | None) -> None:
     if reload and os.environ.get("OWLDNS_RELOAD_CHILD") != "1":
         run_reloader(sys.argv[1:])
     else:
-        start_server(host, port, upstreams, hosts_file)
+        start_server(host, port, config_run)
+
+
+@cli.command()
+@click.option("--host", help="Host to bind (default: 127.0.0.1)")
+@click.option("--port", type=int, help="Port to bind (default: 5353)")
+@click.option("--seconds", type=float, default=30.0, show_default=True,
+              help="How long to run the server under the profiler")
+@click.option("--output", type=click.Path(dir_okay=False), default="owldns.folded",
+              show_default=True, help="Folded stack file (flamegraph.pl / speedscope input)")
+@click.option("--interval", type=float, default=0.005, show_default=True,
+              help="Sampling interval in seconds of CPU time")
+@click.pass_context
+def profile(ctx: click.Context, host: str | None, port: int | None,
+            seconds: float, output: str, interval: float) -> None:
+    """Run the DNS server under a sampling profiler for N seconds."""
+    config_run = owl_config.get("run", {})
+    if host:
+        config_run = {**config_run, "listen": None}
+    host = host or config_run.get("host", "127.0.0.1")
+    port = port or config_run.get("port", 5353)
+
+    setup_logger(level=ctx.obj['log_level'])
+    profile_server(host, port, config_run, seconds, output, interval)
+
+
+@cli.command()
+@click.argument("command", type=click.Choice(
+    ["flush", "add_record", "remove_record", "stats", "upstreams", "log_level"]))
+@click.argument("args", nargs=-1)
+@click.option("--socket", "socket_path", help="Admin Unix socket (default: [run.admin] socket)")
+@click.option("--address", help="Admin host:port (default: [run.admin] address)")
+def admin(command: str, args: tuple[str, ...], socket_path: str | None,
+          address: str | None) -> None:
+    """Send a command to a running server, e.g. `admin flush suffix=example.com`."""
+    config = owl_config.get("run", {}).get("admin", {})
+    if socket_path or address:
+        config = {"socket": socket_path} if socket_path else {"address": address}
+    if not config:
+        raise click.UsageError("No admin endpoint: set [run.admin] or pass --socket / --address")
+
+    params = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep:
+            raise click.UsageError(f"Expected key=value, got: {arg}")
+        params[key] = value
+
+    try:
+        reply = asyncio.run(admin_request(config, command, **params))
+    except OSError as e:
+        raise click.ClickException(f"Cannot reach admin endpoint: {e}") from e
+    click.echo(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        sys.exit(1)
 
 
 def main() -> None:
@@ -194,7 +300,7 @@ def main() -> None:
         sys.argv.append("run")
     else:
         # Check if dynamic subcommands are present
-        subcommands = ["run", "test"]
+        subcommands = ["run", "test", "profile", "admin"]
         has_subcommand = any(arg in subcommands for arg in sys.argv)
         if not has_subcommand and not any(arg in ["--help", "-h"] for arg in sys.argv):
             # If no subcommand found and no help flag, append 'run' at the end
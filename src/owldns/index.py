@@ -0,0 +1,153 @@
+from __future__ import annotations
+import ipaddress
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+_MISSING = object()
+
+
+def normalize_name(name: str) -> str:
+    """Lowercases a domain name and strips the trailing root dot."""
+    return name.rstrip(".").lower()
+
+
+class SuffixIndex(Generic[T]):
+    """
+    Maps domain suffixes to values with longest-suffix matching.
+    A lookup probes one dict entry per label of the queried name, so its cost
+    is O(labels) no matter how many suffixes are indexed.
+    """
+
+    def __init__(self, items: dict[str, T] | None = None):
+        self._map: dict[str, T] = {}
+        for suffix, value in (items or {}).items():
+            self.add(suffix, value)
+
+    def add(self, suffix: str, value: T) -> None:
+        self._map[normalize_name(suffix)] = value
+
+    def remove(self, suffix: str) -> T | None:
+        return self._map.pop(normalize_name(suffix), None)
+
+    def match(self, name: str, default: T | None = None) -> T | None:
+        """Returns the value of the longest indexed suffix of name (already normalized)."""
+        lookup = self._map.get
+        while True:
+            value = lookup(name, _MISSING)
+            if value is not _MISSING:
+                return value  # type: ignore[return-value]
+            dot = name.find(".")
+            if dot < 0:
+                return default
+            name = name[dot + 1:]
+
+    def match_all(self, name: str):
+        """Yields the values of every indexed suffix of name, longest first."""
+        lookup = self._map.get
+        while True:
+            value = lookup(name, _MISSING)
+            if value is not _MISSING:
+                yield value
+            dot = name.find(".")
+            if dot < 0:
+                return
+            name = name[dot + 1:]
+
+    def items(self):
+        return self._map.items()
+
+    def __contains__(self, suffix: str) -> bool:
+        return normalize_name(suffix) in self._map
+
+    def __len__(self) -> int:
+        return len(self._map)
+
+
+class PrefixIndex(Generic[T]):
+    """
+    Maps IPv4/IPv6 networks to values with longest-prefix matching.
+    Networks are compiled into one hash table per (family, prefix length);
+    a lookup probes each configured prefix length from longest to shortest,
+    so it costs at most 32 (IPv4) or 128 (IPv6) probes however many networks exist.
+    """
+
+    def __init__(self, items: dict[str, T] | None = None):
+        # version -> prefix length -> network integer -> value
+        self._tables: dict[int, dict[int, dict[int, T]]] = {4: {}, 6: {}}
+        # version -> prefix lengths in use, longest first
+        self._lengths: dict[int, list[int]] = {4: [], 6: []}
+        for network, value in (items or {}).items():
+            self.add(network, value)
+
+    def add(self, network: str, value: T) -> None:
+        net = ipaddress.ip_network(network, strict=False)
+        bits = net.max_prefixlen
+        tables = self._tables[net.version]
+        if net.prefixlen not in tables:
+            tables[net.prefixlen] = {}
+            self._lengths[net.version] = sorted(tables, reverse=True)
+        tables[net.prefixlen][int(net.network_address) >> (bits - net.prefixlen)] = value
+
+    def match(self, address: str | ipaddress.IPv4Address | ipaddress.IPv6Address,
+              default: T | None = None) -> T | None:
+        """Returns the value of the most specific network containing address."""
+        ip = ipaddress.ip_address(address)
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        bits = ip.max_prefixlen
+        value_int = int(ip)
+        tables = self._tables[ip.version]
+        for length in self._lengths[ip.version]:
+            value = tables[length].get(value_int >> (bits - length), _MISSING)
+            if value is not _MISSING:
+                return value  # type: ignore[return-value]
+        return default
+
+    def __len__(self) -> int:
+        return sum(len(t) for tables in self._tables.values() for t in tables.values())
+
+
+class RecordIndex:
+    """
+    Local records with wildcard patterns ("*.example.com") compiled into a
+    SuffixIndex, so a lookup is one exact probe plus O(labels) suffix probes.
+    A wildcard also answers for its bare suffix ("example.com").
+    """
+
+    def __init__(self, records: dict[str, list[str]] | None = None):
+        self.records: dict[str, list[str]] = records if records is not None else {}
+        self.wildcards: SuffixIndex[list[str]] = SuffixIndex()
+        for pattern, ips in self.records.items():
+            if pattern.startswith("*."):
+                self.wildcards.add(pattern[2:], ips)
+
+    def lookup(self, qname: str) -> list[str] | None:
+        """Returns the IPs of the exact or wildcard entry matching qname."""
+        ips = self.records.get(qname)
+        if ips is None and self.wildcards:
+            ips = self.wildcards.match(normalize_name(qname))
+        return ips
+
+    def add(self, name: str, ip: str) -> None:
+        """Adds an IP to a name or wildcard pattern."""
+        ips = self.records.get(name)
+        if ips is None:
+            ips = self.records[name] = []
+            if name.startswith("*."):
+                self.wildcards.add(name[2:], ips)
+        if ip not in ips:
+            ips.append(ip)
+
+    def remove(self, name: str, ip: str | None = None) -> bool:
+        """Removes one IP (or all IPs) of a name or wildcard pattern. Returns True if found."""
+        ips = self.records.get(name)
+        if ips is None or (ip is not None and ip not in ips):
+            return False
+        if ip is not None:
+            ips.remove(ip)
+        if ip is None or not ips:
+            del self.records[name]
+            if name.startswith("*."):
+                self.wildcards.remove(name[2:])
+        return True
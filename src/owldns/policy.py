@@ -0,0 +1,208 @@
+from __future__ import annotations
+import bisect
+from array import array
+from owldns.index import normalize_name
+from owldns.types import PolicyConfig, PolicySource
+from owldns.utils import logger
+
+# Policy actions. PASSTHRU exempts a name from broader rules (an allowlist entry).
+NXDOMAIN, NODATA, REDIRECT, PASSTHRU = 1, 2, 3, 4
+ACTIONS: dict[str, int] = {"nxdomain": NXDOMAIN, "nodata": NODATA,
+                           "redirect": REDIRECT, "passthru": PASSTHRU}
+ACTION_NAMES: dict[int, str] = {code: name for name, code in ACTIONS.items()}
+
+# Each indexed name carries one code byte: the low nibble is the action for the
+# name itself, the high nibble the action for names below it.
+SELF, BELOW = 0, 4
+
+
+# Two-bit byte masks for the Bloom filter, indexed by a hash's top six bits
+# (h >> 58 lies in [-32, 32); negative indices wrap, so all 64 entries are used)
+BLOOM_PATTERNS: tuple[int, ...] = tuple((1 << (t & 7)) | (1 << (t >> 3)) for t in range(64))
+
+
+class BloomFilter:
+    """
+    A blocked Bloom filter over precomputed 64-bit hashes, used as a prefilter:
+    a negative answer means the key is definitely absent. Each key sets two bits
+    in a single byte chosen by its low hash bits, and the byte count is a power
+    of two, so a probe is a mask, two indexes and a compare with no loop.
+    """
+
+    def __init__(self, capacity: int, bits_per_key: int = 8):
+        size = 64
+        while size * 8 < capacity * bits_per_key:
+            size <<= 1
+        self.mask: int = size - 1
+        self.bits = bytearray(size)
+
+    def add(self, h: int) -> None:
+        self.bits[h & self.mask] |= BLOOM_PATTERNS[h >> 58]
+
+    def might_contain(self, h: int) -> bool:
+        want = BLOOM_PATTERNS[h >> 58]
+        return self.bits[h & self.mask] & want == want
+
+
+class CompactDomainSet:
+    """
+    An immutable domain -> code map stored as two parallel sorted arrays:
+    8-byte name hashes and 1-byte codes (~9 bytes per entry instead of a dict
+    entry plus a str object). Lookups binary-search the hash array, optionally
+    behind a Bloom filter so most misses never touch it.
+    Hash collisions between distinct names are possible but vanishingly rare (2^-64).
+    """
+
+    def __init__(self, entries: dict[str, int], bloom: bool = False):
+        pairs = sorted((hash(name), code) for name, code in entries.items())
+        self.hashes = array("q", (h for h, _ in pairs))
+        self.codes = array("B", (code for _, code in pairs))
+        self.bloom: BloomFilter | None = None
+        if bloom:
+            self.bloom = BloomFilter(len(pairs))
+            for h in self.hashes:
+                self.bloom.add(h)
+
+    def get(self, name: str) -> int:
+        """Returns the code stored for name, or 0 if absent."""
+        h = hash(name)
+        bloom = self.bloom
+        if bloom is not None:
+            # BloomFilter.might_contain, inlined: this runs once per label of every query
+            want = BLOOM_PATTERNS[h >> 58]
+            if bloom.bits[h & bloom.mask] & want != want:
+                return 0
+        i = bisect.bisect_left(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return self.codes[i]
+        return 0
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+
+def parse_domain_list(lines, hosts_format: bool = False):
+    """Yields domains from a plain list (one per line) or a hosts-style file."""
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        for domain in (parts[1:] if hosts_format else parts[:1]):
+            yield domain
+
+
+def parse_rpz(lines):
+    """
+    Yields (owner, action, redirect_ip) from an RPZ zone file (QNAME triggers only).
+    CNAME . -> NXDOMAIN, CNAME *. -> NODATA, CNAME rpz-passthru. -> PASSTHRU,
+    A/AAAA -> REDIRECT. Other triggers and actions are skipped.
+    """
+    origin = ""
+    owner = ""
+    for line in lines:
+        line = line.split(";", 1)[0].rstrip()
+        if not line.strip():
+            continue
+        if line.startswith("$ORIGIN"):
+            origin = normalize_name(line.split()[1])
+            continue
+        if line.startswith("$"):
+            continue
+
+        parts = line.split()
+        if not line[0].isspace():
+            owner = parts.pop(0)
+        # Drop optional TTL and class before the record type
+        while parts and (parts[0].isdigit() or parts[0].upper() in ("IN", "CH", "HS")):
+            parts.pop(0)
+        if len(parts) < 2:
+            continue
+
+        rtype, rdata = parts[0].upper(), parts[1].lower()
+        name = normalize_name(owner)
+        if owner.endswith("."):
+            if origin and name.endswith("." + origin):
+                name = name[:-len(origin) - 1]
+        elif owner == "@":
+            continue
+
+        if rtype == "CNAME" and rdata == ".":
+            yield name, NXDOMAIN, None
+        elif rtype == "CNAME" and rdata == "*.":
+            yield name, NODATA, None
+        elif rtype == "CNAME" and rdata == "rpz-passthru.":
+            yield name, PASSTHRU, None
+        elif rtype in ("A", "AAAA"):
+            yield name, REDIRECT, parts[1]
+
+
+class PolicyEngine:
+    """
+    Response policy (blocklist / RPZ) applied between local records and forwarding.
+    Lookups walk the queried name and its parents, one probe per label, and
+    the most specific rule wins, so a PASSTHRU entry can exempt a subdomain.
+    """
+
+    def __init__(self, config: PolicyConfig | None = None):
+        config = config or {}
+        entries: dict[str, int] = {}
+        # Redirect targets by rule owner ("*.x" for rules on names below x)
+        self.redirects: dict[str, list[str]] = {}
+        for source in config.get("sources", []):
+            self.load_source(source, entries)
+        self.names = CompactDomainSet(entries, bloom=config.get("bloom", False))
+        logger.debug("Loaded %d policy names", len(self.names))
+
+    def add_rule(self, entries: dict[str, int], name: str, action: int,
+                 subdomains: bool, redirect: list[str] | None = None) -> None:
+        """Adds a rule for name (and/or the names below it) to the build table."""
+        name = normalize_name(name)
+        if name.startswith("*."):
+            name = name[2:]
+            shifts = (BELOW,)
+        else:
+            shifts = (SELF, BELOW) if subdomains else (SELF,)
+        code = entries.get(name, 0)
+        for shift in shifts:
+            code = (code & ~(0xF << shift)) | (action << shift)
+            if action == REDIRECT and redirect:
+                key = name if shift == SELF else "*." + name
+                self.redirects.setdefault(key, []).extend(redirect)
+        entries[name] = code
+
+    def load_source(self, source: PolicySource, entries: dict[str, int]) -> None:
+        """Loads one blocklist source (domains, hosts or rpz format) into the build table."""
+        path = source["file"]
+        fmt = source.get("format", "domains")
+        action = ACTIONS[source.get("action", "nxdomain")]
+        redirect = source.get("redirect", [])
+        # Plain lists block the listed domains and everything below them
+        subdomains = source.get("subdomains", True)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                if fmt == "rpz":
+                    for name, rpz_action, ip in parse_rpz(f):
+                        self.add_rule(entries, name, rpz_action, False, [ip] if ip else None)
+                else:
+                    for name in parse_domain_list(f, hosts_format=fmt == "hosts"):
+                        self.add_rule(entries, name, action, subdomains, redirect)
+        except Exception as e:
+            logger.error("Error loading policy source %s: %s", path, e)
+
+    def match(self, name: str) -> tuple[int, list[str] | None]:
+        """
+        Returns (action, redirect_ips) for a normalized name, or (0, None) if no rule applies.
+        """
+        if not self.names:
+            return 0, None
+        get = self.names.get
+        action = get(name) & 0xF
+        if action:
+            return action, self.redirects.get(name) if action == REDIRECT else None
+        while (dot := name.find(".")) >= 0:
+            name = name[dot + 1:]
+            action = get(name) >> BELOW
+            if action:
+                return action, self.redirects.get("*." + name) if action == REDIRECT else None
+        return 0, None
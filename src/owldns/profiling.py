@@ -0,0 +1,122 @@
+from __future__ import annotations
+import collections
+import signal
+import time
+from types import FrameType
+
+# Hot-path stages, in lifecycle order (indices into LatencyHistograms.counts)
+STAGES: tuple[str, ...] = ("parse", "local", "cache", "forward", "send", "total")
+PARSE, LOCAL, CACHE, FORWARD, SEND, TOTAL = range(len(STAGES))
+
+# Bucket i counts samples in [2**(i-1), 2**i) ns; the last bucket is open-ended (> ~9 min)
+BUCKETS = 40
+
+
+class LatencyHistograms:
+    """
+    Fixed-size log2 latency histograms, one per hot-path stage.
+    All buckets are preallocated, so recording a sample is one index and one
+    increment with no per-query allocation.
+
+    Increments are not synchronised, so each event loop records into its own
+    instance: worker loops get one from fork(), and the summary merges them.
+    """
+
+    def __init__(self):
+        self.counts: list[list[int]] = [[0] * BUCKETS for _ in STAGES]
+        # Histograms written by other threads' loops, merged on read
+        self.forks: list[LatencyHistograms] = []
+
+    def fork(self) -> LatencyHistograms:
+        """Returns a histogram for another event loop, included in this one's summary."""
+        child = LatencyHistograms()
+        self.forks.append(child)
+        return child
+
+    def merged(self) -> list[list[int]]:
+        """Per-stage bucket counts summed over this histogram and its forks."""
+        if not self.forks:
+            return [list(buckets) for buckets in self.counts]
+        histograms = [self, *self.forks]
+        return [[sum(column) for column in zip(*(h.counts[stage] for h in histograms))]
+                for stage in range(len(STAGES))]
+
+    def record(self, stage: int, elapsed_ns: int) -> None:
+        self.counts[stage][min(elapsed_ns.bit_length(), BUCKETS - 1)] += 1
+
+    def lap(self, stage: int, since_ns: int) -> int:
+        """Records the time elapsed since since_ns for stage and returns the current time."""
+        now = time.perf_counter_ns()
+        self.counts[stage][min((now - since_ns).bit_length(), BUCKETS - 1)] += 1
+        return now
+
+    def reset(self) -> None:
+        for buckets in self.counts:
+            buckets[:] = [0] * BUCKETS
+        for child in self.forks:
+            child.reset()
+
+    @staticmethod
+    def percentile(buckets: list[int], fraction: float) -> int:
+        """Returns the upper bound (ns) of the bucket holding the given fraction of samples."""
+        target = fraction * sum(buckets)
+        seen = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if count and seen >= target:
+                return 1 << index
+        return 0
+
+    def summary(self) -> dict[str, dict[str, int]]:
+        """Per-stage sample count and p50/p90/p99 upper bounds in nanoseconds."""
+        return {
+            stage: {
+                "count": sum(buckets),
+                "p50_ns": self.percentile(buckets, 0.50),
+                "p90_ns": self.percentile(buckets, 0.90),
+                "p99_ns": self.percentile(buckets, 0.99),
+            }
+            for stage, buckets in zip(STAGES, self.merged())
+        }
+
+    def format(self) -> str:
+        """Renders the summary as a fixed-width table."""
+        lines = [f"{'stage':<8} {'count':>10} {'p50(us)':>10} {'p90(us)':>10} {'p99(us)':>10}"]
+        for stage, row in self.summary().items():
+            lines.append(f"{stage:<8} {row['count']:>10} {row['p50_ns'] / 1000:>10.1f} "
+                         f"{row['p90_ns'] / 1000:>10.1f} {row['p99_ns'] / 1000:>10.1f}")
+        return "\n".join(lines)
+
+
+class StackSampler:
+    """
+    A signal-driven sampling profiler.
+    Every interval of CPU time, SIGPROF interrupts the main thread and the
+    current stack is counted. The result is written in the folded format
+    ("root;caller;leaf count") read by flamegraph.pl, speedscope and inferno.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: collections.Counter[str] = collections.Counter()
+
+    def start(self) -> None:
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum: int, frame: FrameType | None) -> None:
+        stack: list[str] = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}:{code.co_firstlineno}")
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
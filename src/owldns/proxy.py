@@ -0,0 +1,90 @@
+from __future__ import annotations
+import asyncio
+import base64
+import ipaddress
+import socket
+from owldns.utils import parse_proxy_address
+
+# SOCKS5 reply codes (RFC 1928, section 6)
+SOCKS5_ERRORS: dict[int, str] = {
+    1: "general failure", 2: "connection not allowed", 3: "network unreachable",
+    4: "host unreachable", 5: "connection refused", 6: "TTL expired",
+    7: "command not supported", 8: "address type not supported",
+}
+
+
+async def open_proxy_connection(proxy: str, host: str, port: int
+                                ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """
+    Opens a TCP tunnel to host:port through a SOCKS5 or HTTP CONNECT proxy.
+    The returned streams carry raw bytes to the target; TLS can be layered on top.
+    """
+    scheme, proxy_host, proxy_port, username, password = parse_proxy_address(proxy)
+    reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        # Tunnels are pooled for a long time; let the kernel detect dead peers
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    try:
+        if scheme == "http":
+            await http_connect(reader, writer, host, port, username, password)
+        else:
+            await socks5_connect(reader, writer, host, port, username, password)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def socks5_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         host: str, port: int, username: str | None = None,
+                         password: str | None = None) -> None:
+    """Performs the SOCKS5 greeting, optional auth (RFC 1929) and CONNECT request."""
+    methods = b"\x00\x02" if username else b"\x00"
+    writer.write(b"\x05" + bytes([len(methods)]) + methods)
+    version, method = await reader.readexactly(2)
+    if version != 5 or method == 0xFF:
+        raise ConnectionError("SOCKS5 proxy rejected authentication methods")
+
+    if method == 2:
+        user, pwd = (username or "").encode(), (password or "").encode()
+        writer.write(b"\x01" + bytes([len(user)]) + user + bytes([len(pwd)]) + pwd)
+        _, status = await reader.readexactly(2)
+        if status != 0:
+            raise ConnectionError("SOCKS5 proxy authentication failed")
+
+    try:
+        ip = ipaddress.ip_address(host)
+        address = (b"\x01" if ip.version == 4 else b"\x04") + ip.packed
+    except ValueError:
+        name = host.encode("idna")
+        address = b"\x03" + bytes([len(name)]) + name
+    writer.write(b"\x05\x01\x00" + address + port.to_bytes(2, "big"))
+
+    _, reply, _, atyp = await reader.readexactly(4)
+    if reply != 0:
+        raise ConnectionError(
+            f"SOCKS5 connect failed: {SOCKS5_ERRORS.get(reply, reply)}")
+    # Skip the bound address, which is of no use for a CONNECT tunnel
+    if atyp == 3:
+        await reader.readexactly((await reader.readexactly(1))[0] + 2)
+    else:
+        await reader.readexactly((4 if atyp == 1 else 16) + 2)
+
+
+async def http_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                       host: str, port: int, username: str | None = None,
+                       password: str | None = None) -> None:
+    """Opens a tunnel with an HTTP/1.1 CONNECT request."""
+    target = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+    request = f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n"
+    if username:
+        token = base64.b64encode(f"{username}:{password or ''}".encode()).decode()
+        request += f"Proxy-Authorization: Basic {token}\r\n"
+    writer.write((request + "\r\n").encode())
+
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = head.split(b" ", 2)[1]
+    if status != b"200":
+        raise ConnectionError(f"HTTP CONNECT failed with status {status.decode()}")
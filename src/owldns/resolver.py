@@ -1,9 +1,20 @@
 from __future__ import annotations
 import asyncio
-from dnslib import DNSRecord, QTYPE, RR, A, AAAA
+import copy
+import random
+import secrets
+import time
+from dnslib import DNSRecord, QTYPE, RCODE, RR, A, AAAA
 import socket
-from owldns.types import DNSDict, UpstreamServer
-from owldns.utils import logger
+from owldns.cache import DNSCache, ShardedDNSCache
+from owldns.index import RecordIndex, SuffixIndex, normalize_name
+from owldns.policy import ACTION_NAMES, NXDOMAIN, PASSTHRU, PolicyEngine
+from owldns.profiling import CACHE, FORWARD, LOCAL, PARSE, LatencyHistograms
+from owldns.types import CacheConfig, DNSDict, PolicyConfig, UpstreamGroup, UpstreamServer, View
+from owldns.upstream import (StreamUpstream, UpstreamHealth, question_section, randomize_case,
+                             response_matches)
+from owldns.utils import logger, parse_upstream_address
+from owldns.views import ViewTable
 
 
 class Resolver:
@@ -11,38 +22,86 @@ class Resolver:
     DNS Resolver that handles local record lookup and upstream forwarding.
     """
 
-    def __init__(self, records: DNSDict | None = None, upstreams: list[UpstreamServer] | None = None):
+    STRATEGIES = ("sequential", "random", "race")
+
+    def __init__(self, records: DNSDict | None = None, upstreams: list[UpstreamServer] | None = None,
+                 groups: dict[str, UpstreamGroup] | None = None, views: list[View] | None = None,
+                 cache: CacheConfig | None = None, nxdomain: list[str] | None = None,
+                 policy: PolicyConfig | None = None, minimal_responses: bool = False,
+                 dns0x20: bool = False, ecs_trusted: list[str] | None = None):
         self.records: DNSDict = records or {}
+        # Exact and compiled wildcard lookups over self.records
+        self.local: RecordIndex = RecordIndex(self.records)
         self.upstreams: list[UpstreamServer] = upstreams if upstreams is not None else [
             {"address": "1.1.1.1", "group": None, "proxy": None}]
+        self.groups: dict[str, UpstreamGroup] = groups or {}
+        # Domain suffix -> group name, compiled once so routing costs O(labels) per query
+        self.routes: SuffixIndex[str] = SuffixIndex()
+        for name, group in self.groups.items():
+            if group.get("strategy", "sequential") not in self.STRATEGIES:
+                raise ValueError(f"Unknown strategy for group {name}: {group['strategy']}")
+            for domain in group.get("domains", []):
+                self.routes.add(domain, name)
+        # Split-horizon views, selected per query by client address
+        # (or the ECS prefix sent by an ecs_trusted source)
+        self.views: ViewTable = ViewTable(views, ecs_trusted)
+        # A routed or view-referenced group nobody serves would silently never be forwarded
+        referenced = {name for name, group in self.groups.items() if group.get("domains")}
+        referenced.update(view["group"] for view in self.views.views.values() if view.get("group"))
+        for name in sorted(referenced):
+            if not self.select_upstreams(name):
+                raise ValueError(f"No upstreams for group {name} (tag one with --group {name})")
+        # Strip authority/additional records that the client did not ask for
+        self.minimal_responses: bool = minimal_responses
+        # Blocklist / RPZ policy applied between local records and forwarding
+        self.policy: PolicyEngine = PolicyEngine(policy)
+        # Answer cache (positive and RFC 2308 negative), scoped per view.
+        # A sharded, locked cache is used when it is shared between threads.
+        cache = cache or {}
+        self.cache: DNSCache | ShardedDNSCache = (
+            ShardedDNSCache(cache, cache["shards"]) if cache.get("shards") else DNSCache(cache))
+        # Suffixes known not to exist, answered NXDOMAIN without going upstream
+        self.nxdomain: SuffixIndex[bool] = SuffixIndex({suffix: True for suffix in nxdomain or []})
+        # Per-stage latency histograms, set by the server when profiling is enabled
+        self.profiler: LatencyHistograms | None = None
+        # Randomize the case of forwarded UDP question names (requires case-preserving upstreams)
+        self.dns0x20: bool = dns0x20
+        # Per-upstream success/failure counters and round-trip times, keyed by address;
+        # each event loop keeps its own map and loop_health lists them all for merging
+        self.health: dict[str, UpstreamHealth] = {}
+        self.loop_health: list[dict[str, UpstreamHealth]] = [self.health]
+        # Persistent connection pools for tls://, https:// and proxied upstreams,
+        # keyed by (address, proxy)
+        self.streams: dict[tuple[str, str | None], StreamUpstream] = {}
 
-    def resolve_local(self, request: DNSRecord) -> bytes | None:
+    def resolve_local(self, request: DNSRecord, view: View | None = None) -> bytes | None:
         """
         Attempts to resolve the query using local records.
+        A view's own records take precedence over the global records.
         Returns packed DNS response if hit, otherwise None.
         """
         qname: str = str(request.q.qname).rstrip('.')
         qtype: int = request.q.qtype
 
         # Match domain pattern
-        matching_domain: str | None = None
-        if qname in self.records:
-            matching_domain = qname
-        else:
-            for pattern in self.records:
-                if pattern.startswith("*."):
-                    suffix = pattern[2:]
-                    if qname.endswith(suffix) and (qname == suffix or qname.endswith("." + suffix)):
-                        matching_domain = pattern
-                        break
+        ips: list[str] | None = None
+        if view and view["name"] in self.views.records:
+            ips = self.views.records[view["name"]].lookup(qname)
+        if ips is None:
+            ips = self.local.lookup(qname)
 
-        if not matching_domain:
+        if ips is None:
             return None
 
-        # Build response
-        reply = request.reply()
-        ips = self.records[matching_domain]
         logger.debug("Local hit: %s [%s] -> %s", qname, QTYPE.get(qtype), ips)
+        return self.build_answer(request, ips)
+
+    @staticmethod
+    def build_answer(request: DNSRecord, ips: list[str]) -> bytes | None:
+        """Builds a packed A/AAAA answer from ips, or None if none fit the qtype."""
+        qname: str = str(request.q.qname).rstrip('.')
+        qtype: int = request.q.qtype
+        reply = request.reply()
 
         if qtype == QTYPE.A:
             for ip in ips:
@@ -55,71 +114,312 @@ class Resolver:
 
         return reply.pack() if reply.rr else None
 
-    async def resolve(self, data: bytes) -> bytes:
+    def apply_policy(self, request: DNSRecord, name: str) -> bytes | None:
+        """Returns the policy answer for a blocked or redirected name, or None to continue."""
+        action, redirect = self.policy.match(name)
+        if not action or action == PASSTHRU:
+            return None
+
+        logger.debug("Policy hit: %s -> %s", name, ACTION_NAMES[action])
+        if redirect:
+            answer = self.build_answer(request, redirect)
+            if answer:
+                return answer
+        # NODATA, or a redirect without addresses of the queried type
+        reply = request.reply()
+        if action == NXDOMAIN:
+            reply.header.rcode = RCODE.NXDOMAIN
+        return reply.pack()
+
+    async def resolve(self, data: bytes, addr: tuple[str, int] | None = None) -> bytes:
         """
         Parses the DNS query and attempts to resolve it locally or via upstream.
+        addr is the client address, used to pick a split-horizon view.
         """
+        profiler = self.profiler
+        mark = time.perf_counter_ns() if profiler else 0
+
         request: DNSRecord = DNSRecord.parse(data)
         qname: str = str(request.q.qname).rstrip('.')
         qtype: int = request.q.qtype
+        if profiler:
+            mark = profiler.lap(PARSE, mark)
 
-        # TODO: Implement GeoDNS & Split-Horizon Routing based on client IP
+        # 0. Select the split-horizon view from the client address / ECS option
+        view = self.views.select(request, addr)
 
         # 1. Attempt local resolution
-        local_response = self.resolve_local(request)
+        local_response = self.resolve_local(request, view)
+        if profiler:
+            mark = profiler.lap(LOCAL, mark)
         if local_response:
             return local_response
 
         logger.debug("Local miss: %s [%s]", qname, QTYPE.get(qtype))
 
-        # 2. If not found locally, forward to configured upstreams
-        reply: DNSRecord = request.reply()
+        # 2. Apply blocklist / RPZ policy
+        name = normalize_name(qname)
+        policy_response = self.apply_policy(request, name)
+        if policy_response:
+            return policy_response
 
-        # If not found locally, forward to configured upstreams
-        for upstream in self.upstreams:
-            upstream_ip = upstream["address"]
-            if not upstream_ip:
-                continue
-            try:
-                response = await self.forward(data, upstream_ip)
-                # Parse response to extract IPs for logging
-                resp_record = DNSRecord.parse(response)
-                ips = [str(r.rdata)
-                       for r in resp_record.rr if r.rtype in (QTYPE.A, QTYPE.AAAA)]
-                logger.debug(
-                    "Upstream hit (%s): %s [%s] -> %s", upstream_ip, qname, QTYPE.get(qtype), ips)
-                return response
-            except Exception as e:
-                logger.warning("Upstream %s failed for %s: %s",
-                               upstream_ip, qname, e)
+        # 3. Answer denials locally: configured non-existent suffixes, then the cache
+        if self.nxdomain.match(name):
+            logger.debug("Known non-existent: %s", qname)
+            reply = request.reply()
+            reply.header.rcode = RCODE.NXDOMAIN
+            return reply.pack()
+
+        view_name = view["name"] if view else ""
+        cache_key = (view_name, name, qtype)
+        if self.cache.size:
+            cached = (self.cache.get_nxdomain(view_name, name, request,
+                                              self.cache.config.get("aggressive_nxdomain", False))
+                      or self.cache.get(cache_key, request))
+            if profiler:
+                mark = profiler.lap(CACHE, mark)
+            if cached:
+                logger.debug("Cache hit: %s [%s]", qname, QTYPE.get(qtype))
+                return cached
+
+        # 4. Forward to the upstream group routed for qname, falling back to the view's group
+        group_name = self.routes.match(name)
+        if group_name is None and view:
+            group_name = view.get("group")
+        response = await self.forward_group(data, qname, group_name)
+        if profiler:
+            profiler.lap(FORWARD, mark)
+        if response is not None:
+            if self.minimal_responses or self.cache.size:
+                record = DNSRecord.parse(response)
+                if self.minimal_responses and self.minimize(record):
+                    response = record.pack()
+                if self.cache.size:
+                    # The cache keeps the minimized form
+                    self.cache.put(cache_key, record, response)
+            return response
+
+        return request.reply().pack()
+
+    @staticmethod
+    def minimize(response: DNSRecord) -> bool:
+        """
+        Drops records a stub resolver does not need, in place: the authority
+        section (except the SOA of a negative answer, which it needs for negative
+        caching) and additional records other than the EDNS OPT record.
+        Returns True if anything was removed.
+        """
+        auth = [] if response.rr else [rr for rr in response.auth if rr.rtype == QTYPE.SOA]
+        additional = [rr for rr in response.ar if rr.rtype == QTYPE.OPT]
+        if len(auth) == len(response.auth) and len(additional) == len(response.ar):
+            return False
+        response.auth = auth
+        response.ar = additional
+        return True
+
+    async def forward_group(self, data: bytes, qname: str, group_name: str | None) -> bytes | None:
+        """
+        Forwards the query to a group's upstreams using the group's strategy and timeout.
+        A named group without upstreams answers SERVFAIL.
+        """
+        upstreams = self.select_upstreams(group_name)
+        if not upstreams and group_name is not None:
+            logger.error("No upstreams for group %s; answering SERVFAIL for %s", group_name, qname)
+            reply = DNSRecord.parse(data).reply()
+            reply.header.rcode = RCODE.SERVFAIL
+            return reply.pack()
+        group: UpstreamGroup = self.groups.get(group_name, {}) if group_name else {}
+        strategy = group.get("strategy", "sequential")
+        timeout = group.get("timeout", 2.0)
 
-        if self.upstreams:
+        response = None
+        if strategy == "race" and len(upstreams) > 1:
+            response = await self.forward_race(data, qname, upstreams, timeout)
+        else:
+            if strategy == "random":
+                upstreams = random.sample(upstreams, len(upstreams))
+            for upstream in upstreams:
+                response = await self.forward_logged(data, qname, upstream, timeout)
+                if response is not None:
+                    break
+
+        if response is None and upstreams:
             logger.error("All upstreams failed for %s", qname)
+        return response
 
-        return reply.pack()
+    def select_upstreams(self, group_name: str | None) -> list[UpstreamServer]:
+        """
+        Returns the upstreams serving a group.
+        Unrouted queries (group_name None) use upstreams without a group,
+        falling back to every upstream when all of them are grouped.
+        """
+        upstreams = [u for u in self.upstreams if u["address"] and u["group"] == group_name]
+        if not upstreams and group_name is None:
+            upstreams = [u for u in self.upstreams if u["address"]]
+        return upstreams
+
+    async def forward_logged(self, data: bytes, qname: str, upstream: UpstreamServer,
+                             timeout: float) -> bytes | None:
+        """Forwards to one upstream, logging the outcome. Returns None on failure."""
+        upstream_ip = upstream["address"]
+        health = self.upstream_health(upstream_ip)
+        started = time.perf_counter()
+        try:
+            response = await self.forward(data, upstream_ip, timeout=timeout,
+                                          proxy=upstream["proxy"])
+            health.success((time.perf_counter() - started) * 1000)
+            # Parse response to extract IPs for logging
+            resp_record = DNSRecord.parse(response)
+            ips = [str(r.rdata)
+                   for r in resp_record.rr if r.rtype in (QTYPE.A, QTYPE.AAAA)]
+            logger.debug(
+                "Upstream hit (%s): %s [%s] -> %s", upstream_ip, qname,
+                QTYPE.get(resp_record.q.qtype), ips)
+            return response
+        except Exception as e:
+            health.failure(e)
+            logger.warning("Upstream %s failed for %s: %s",
+                           upstream_ip, qname, e)
+            return None
+
+    def upstream_health(self, address: str) -> UpstreamHealth:
+        health = self.health.get(address)
+        if health is None:
+            health = self.health[address] = UpstreamHealth()
+        return health
+
+    def merged_health(self) -> dict[str, UpstreamHealth]:
+        """Returns upstream health combined across every event loop's counters."""
+        parts: dict[str, list[UpstreamHealth]] = {}
+        # Other loops may add upstreams meanwhile; dict.copy() is safe against that
+        for health in list(self.loop_health):
+            for address, counters in health.copy().items():
+                parts.setdefault(address, []).append(counters)
+        return {address: UpstreamHealth.merged(counters) for address, counters in parts.items()}
 
-    async def forward(self, data: bytes, upstream_ip: str) -> bytes:
+    async def forward_race(self, data: bytes, qname: str, upstreams: list[UpstreamServer],
+                           timeout: float) -> bytes | None:
+        """Queries all upstreams concurrently and returns the first successful answer."""
+        tasks = [asyncio.create_task(self.forward_logged(data, qname, u, timeout))
+                 for u in upstreams]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                response = await next_done
+                if response is not None:
+                    return response
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def forward(self, data: bytes, upstream_ip: str, timeout: float = 2.0,
+                      proxy: str | None = None) -> bytes:
         """
-        Forwards the DNS query to a specific upstream DNS server via UDP.
-        Supports both IPv4 and IPv6 upstream addresses.
+        Forwards the DNS query to a specific upstream DNS server.
+        Plain addresses use UDP (IPv4 or IPv6); tls:// and https:// addresses
+        go through a pooled DNS-over-TLS / DNS-over-HTTPS connection.
+        With a proxy, queries travel over a pooled tunnel (plain upstreams switch to TCP).
+
+        UDP queries go out with a random transaction ID (and, with dns0x20, a
+        randomly cased name). Only a response from the upstream's address with
+        that ID and the exact question is accepted; anything else is dropped
+        unparsed and counted, and the wait continues until the timeout.
         """
+        if proxy or ("://" in upstream_ip and not upstream_ip.startswith("udp://")):
+            return await self.forward_stream(data, upstream_ip, timeout, proxy)
+
         loop = asyncio.get_running_loop()
 
+        # Upstream DNS usually listens on port 53; udp://host:port selects another
+        host, port = upstream_ip, 53
+        if "://" in upstream_ip:
+            _, host, port, _, _ = parse_upstream_address(upstream_ip)
+
         # Determine if upstream is IPv4 or IPv6
-        is_ipv6: bool = ":" in upstream_ip
+        is_ipv6: bool = ":" in host
         family = socket.AF_INET6 if is_ipv6 else socket.AF_INET
 
+        try:
+            question = question_section(data)
+        except ValueError as e:
+            raise RuntimeError(f"Cannot forward malformed query: {e}") from e
+        sent_question = randomize_case(question) if self.dns0x20 else question
+        query_id = secrets.token_bytes(2)
+        end = 12 + len(question)
+
         # UDP forwarding session
         with socket.socket(family, socket.SOCK_DGRAM) as sock:
             sock.setblocking(False)
             try:
-                # Upstream DNS usually listens on port 53
-                await loop.sock_connect(sock, (upstream_ip, 53))
-                await loop.sock_sendall(sock, data)
-                # Simple timeout for forwarding to avoid hanging
-                return await asyncio.wait_for(loop.sock_recv(sock, 512), timeout=2.0)
+                # A connected UDP socket only receives datagrams from the upstream's address
+                await loop.sock_connect(sock, (host, port))
+                await loop.sock_sendall(sock, query_id + data[2:12] + sent_question + data[end:])
+                deadline = loop.time() + timeout
+                while True:
+                    packet = await asyncio.wait_for(loop.sock_recv(sock, 512),
+                                                    timeout=deadline - loop.time())
+                    if response_matches(packet, query_id, sent_question):
+                        break
+                    self.upstream_health(upstream_ip).mismatched += 1
+                    logger.debug("Dropped mismatched response from %s", upstream_ip)
+                # Hand the client back its own ID and question spelling
+                return data[:2] + packet[2:12] + question + packet[end:]
             except asyncio.TimeoutError as e:
                 raise RuntimeError(f"Upstream {upstream_ip} timeout") from e
             except Exception as e:
                 raise RuntimeError(
                     f"Failed to forward to upstream {upstream_ip}: {e}") from e
+
+    async def forward_stream(self, data: bytes, address: str, timeout: float = 2.0,
+                             proxy: str | None = None) -> bytes:
+        """Forwards the DNS query over the persistent connection pool for address."""
+        stream = self.streams.get((address, proxy))
+        if stream is None:
+            stream = self.streams[(address, proxy)] = StreamUpstream.from_address(
+                address, proxy=proxy, health=self.upstream_health(address))
+        try:
+            return await stream.query(data, timeout=timeout)
+        except asyncio.TimeoutError as e:
+            raise RuntimeError(f"Upstream {address} timeout") from e
+        except Exception as e:
+            raise RuntimeError(
+                f"Failed to forward to upstream {address}: {e}") from e
+
+    def add_record(self, name: str, ip: str, view: str | None = None) -> None:
+        """Adds a local record (globally or to a view) at runtime."""
+        self.record_index(view, create=True).add(name, ip)
+
+    def remove_record(self, name: str, ip: str | None = None, view: str | None = None) -> bool:
+        """Removes a local record (one IP or all of them) at runtime. Returns True if found."""
+        index = self.record_index(view)
+        return index.remove(name, ip) if index else False
+
+    def record_index(self, view: str | None, create: bool = False) -> RecordIndex | None:
+        """Returns the global record index, or a view's (optionally creating it)."""
+        if view is None:
+            return self.local
+        if view not in self.views.views:
+            raise KeyError(f"Unknown view: {view}")
+        index = self.views.records.get(view)
+        if index is None and create:
+            records = self.views.views[view].setdefault("records", {})
+            index = self.views.records[view] = RecordIndex(records)
+        return index
+
+    def clone(self) -> Resolver:
+        """
+        Returns a resolver for another thread's event loop. Records, routing,
+        policy and cache are shared; upstream connection pools and health
+        counters are per loop.
+        """
+        twin = copy.copy(self)
+        twin.streams = {}
+        twin.health = {}
+        self.loop_health.append(twin.health)
+        return twin
+
+    def close(self) -> None:
+        """Closes all pooled upstream connections."""
+        for stream in self.streams.values():
+            stream.close()
+        self.streams.clear()
@@ -1,7 +1,71 @@
 import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from owldns.admin import AdminServer
+from owldns.cache import load_snapshot, save_snapshot
+from owldns.profiling import SEND, TOTAL, LatencyHistograms
 from owldns.resolver import Resolver
-from owldns.types import DNSDict, UpstreamServer
-from owldns.utils import logger
+from owldns.types import (AdminConfig, CacheConfig, DNSDict, ListenConfig, PolicyConfig,
+                          UpstreamGroup, UpstreamServer, View)
+from owldns.utils import logger, parse_listen_address
+
+# Socket handoff: the old process lists its listening fds and the write end of
+# a readiness pipe in these variables when it starts its replacement.
+LISTEN_FDS_ENV = "OWLDNS_LISTEN_FDS"
+READY_FD_ENV = "OWLDNS_READY_FD"
+
+# Linux value of IP_FREEBIND, which the socket module does not export
+IP_FREEBIND = getattr(socket, "IP_FREEBIND", 15)
+
+
+def open_socket(sockaddr: tuple, family: int, options: ListenConfig,
+                reuse_port: bool = False) -> socket.socket:
+    """Creates a bound, non-blocking UDP socket with the per-listener options applied."""
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6 and options.get("v6only") is not None:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, int(options["v6only"]))
+        for key, option, limit in (("rcvbuf", socket.SO_RCVBUF, "rmem_max"),
+                                   ("sndbuf", socket.SO_SNDBUF, "wmem_max")):
+            size = options.get(key)
+            if size:
+                sock.setsockopt(socket.SOL_SOCKET, option, size)
+                # The kernel silently caps the size at net.core.rmem_max / wmem_max
+                if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                    logger.warning("%s %d for %s capped at %d bytes; raise net.core.%s",
+                                   key, size, sockaddr[0], sock.getsockopt(socket.SOL_SOCKET, option),
+                                   limit)
+        if options.get("freebind"):
+            sock.setsockopt(socket.SOL_IP, IP_FREEBIND, 1)
+        sock.bind(sockaddr)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def inherited_sockets() -> list[socket.socket]:
+    """Takes over the listening sockets passed in by a restarting predecessor, if any."""
+    fds = os.environ.pop(LISTEN_FDS_ENV, "")
+    return [socket.socket(fileno=int(fd)) for fd in fds.split(",") if fd]
+
+
+def notify_ready() -> None:
+    """Tells a restarting predecessor that this process is serving, so it can drain."""
+    fd = os.environ.pop(READY_FD_ENV, "")
+    if fd:
+        try:
+            os.write(int(fd), b"1")
+        finally:
+            os.close(int(fd))
 
 
 class OwlDNSProtocol(asyncio.DatagramProtocol):
@@ -9,9 +73,15 @@ class OwlDNSProtocol(asyncio.DatagramProtocol):
     Asyncio DatagramProtocol for handling UDP DNS queries.
     """
 
-    def __init__(self, resolver: Resolver):
+    def __init__(self, resolver: Resolver, profiler: LatencyHistograms | None = None):
         self.resolver: Resolver = resolver
+        self.profiler: LatencyHistograms | None = profiler
         self.transport: asyncio.DatagramTransport | None = None
+        # Queries being resolved, awaited on drain
+        self.tasks: set[asyncio.Task] = set()
+        # Duplicate of the listening socket, used to answer in-flight queries once
+        # the transport stops reading
+        self.reply_socket: socket.socket | None = None
 
     def connection_made(self, transport: asyncio.DatagramTransport):
         """Called when the transport is established."""
@@ -19,45 +89,383 @@ class OwlDNSProtocol(asyncio.DatagramProtocol):
 
     def datagram_received(self, data: bytes, addr: tuple[str, int]):
         """Asynchronously handles incoming UDP datagrams."""
-        asyncio.create_task(self.handle_query(data, addr))
+        task = asyncio.create_task(self.handle_query(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
     async def handle_query(self, data: bytes, addr: tuple[str, int]) -> None:
         """Processes a DNS query and sends the response back to the client."""
+        profiler = self.profiler
+        start = time.perf_counter_ns() if profiler else 0
         try:
-            response = await self.resolver.resolve(data)
+            response = await self.resolver.resolve(data, addr)
             if response:
-                self.transport.sendto(response, addr)
+                mark = time.perf_counter_ns() if profiler else 0
+                self.send(response, addr)
+                if profiler:
+                    profiler.lap(SEND, mark)
+                    profiler.lap(TOTAL, start)
         except Exception as e:
             logger.error("Error handling query from %s: %s", addr, e)
 
+    def send(self, response: bytes, addr: tuple[str, int]) -> None:
+        if self.reply_socket is None:
+            self.transport.sendto(response, addr)
+            return
+        try:
+            self.reply_socket.sendto(response, addr)
+        except OSError as e:
+            logger.warning("Dropped answer to %s while draining: %s", addr, e)
+
+    def stop_reading(self) -> None:
+        """
+        Stops receiving queries. The transport is closed, but a duplicate of
+        its socket is kept for answering the queries still in flight; the socket
+        itself stays bound for as long as another process or thread holds it.
+        """
+        if self.transport is None or self.transport.is_closing():
+            return
+        sock = self.transport.get_extra_info("socket")
+        if sock is not None:
+            self.reply_socket = socket.socket(sock.family, sock.type, fileno=os.dup(sock.fileno()))
+            self.reply_socket.setblocking(False)
+        self.transport.close()
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Stops reading and waits up to timeout seconds for in-flight queries.
+        Queries still pending at the deadline are cancelled; returns how many.
+        """
+        self.stop_reading()
+        pending: set[asyncio.Task] = set()
+        if self.tasks:
+            _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        if self.reply_socket is not None:
+            self.reply_socket.close()
+            self.reply_socket = None
+        return len(pending)
+
 
 class OwlDNSServer:
     """
     The main DNS server class that manages the resolver and the network endpoint.
+    SIGTERM drains gracefully; SIGUSR2 hands the listening sockets to a freshly
+    started process and then drains, so an upgrade drops no queries.
     """
 
     def __init__(self, host: str = "0.0.0.0", port: int = 53,
-                 records: DNSDict | None = None, upstreams: list[UpstreamServer] | None = None):
+                 records: DNSDict | None = None, upstreams: list[UpstreamServer] | None = None,
+                 groups: dict[str, UpstreamGroup] | None = None, views: list[View] | None = None,
+                 cache: CacheConfig | None = None, nxdomain: list[str] | None = None,
+                 policy: PolicyConfig | None = None, minimal_responses: bool = False,
+                 profile: bool = False, threads: int = 1, admin: AdminConfig | None = None,
+                 drain_timeout: float = 5.0, listen: list[str | ListenConfig] | None = None,
+                 dns0x20: bool = False, ecs_trusted: list[str] | None = None):
         self.host: str = host
         self.port: int = port
-        self.resolver: Resolver = Resolver(records, upstreams)
-        self.transport: asyncio.DatagramTransport | None = None
-        self.protocol: OwlDNSProtocol | None = None
+        # Listening addresses (host, port, socket options), all served by one resolver and cache
+        self.listen: list[tuple[str, int, ListenConfig]] = []
+        for item in listen or [{"address": f"[{host}]" if ":" in host else host}]:
+            options: ListenConfig = {"address": item} if isinstance(item, str) else item
+            self.listen.append((*parse_listen_address(options["address"], port), options))
+        # "[::]" is dual-stack by default, which would clash with a "0.0.0.0"
+        # listener on the same port, so only then is it made v6-only
+        ipv4_wildcards = {p for h, p, _ in self.listen if h == "0.0.0.0"}
+        self.listen = [(h, p, {"v6only": True, **o}) if h == "::" and p in ipv4_wildcards else (h, p, o)
+                       for h, p, o in self.listen]
+        # Event loops (one per thread), each on its own SO_REUSEPORT socket
+        self.threads: int = max(1, threads)
+        if self.threads > 1:
+            # The cache is shared by all loops, so it must be sharded and locked
+            cache = {"shards": 16, **(cache or {})}
+        self.resolver: Resolver = Resolver(
+            records, upstreams, groups, views, cache, nxdomain, policy, minimal_responses, dns0x20,
+            ecs_trusted)
+        # Opt-in per-stage latency histograms, dumped on SIGUSR1
+        self.profiler: LatencyHistograms | None = LatencyHistograms() if profile else None
+        self.resolver.profiler = self.profiler
+        # The main loop's endpoints, one per listening address
+        self.transports: list[asyncio.DatagramTransport] = []
+        self.protocols: list[OwlDNSProtocol] = []
+        self.workers: list[threading.Thread] = []
+        self.worker_loops: list[asyncio.AbstractEventLoop] = []
+        self.worker_protocols: list[list[OwlDNSProtocol]] = []
+        # Optional local admin endpoint (cache flush, record changes, stats)
+        self.admin: AdminServer | None = (
+            AdminServer(self.resolver, admin, self.profiler) if admin else None)
+        # Seconds in-flight queries get to finish on shutdown or handoff
+        self.drain_timeout: float = drain_timeout
+        # Listening sockets taken over from a predecessor, not yet claimed
+        self.inherited: list[socket.socket] = []
+        self.stopping: asyncio.Event | None = None
+        # A handoff is waiting for its successor; a second one would start a rival process
+        self.handing_off: bool = False
+        self.handed_off: bool = False
+
+    @property
+    def transport(self) -> asyncio.DatagramTransport | None:
+        """The main loop's first endpoint."""
+        return self.transports[0] if self.transports else None
+
+    @property
+    def protocol(self) -> OwlDNSProtocol | None:
+        return self.protocols[0] if self.protocols else None
+
+    def listen_socket(self, host: str, port: int, options: ListenConfig) -> socket.socket:
+        """
+        Returns a socket for one listener: a matching socket inherited from a
+        predecessor if there is one, otherwise a freshly bound one.
+        """
+        family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        for sock in self.inherited:
+            if sock.family == family and sock.getsockname()[:2] == sockaddr[:2]:
+                self.inherited.remove(sock)
+                return sock
+        return open_socket(sockaddr, family, options, reuse_port=self.threads > 1)
+
+    async def bind(self, resolver: Resolver) -> list[tuple[asyncio.DatagramTransport, OwlDNSProtocol]]:
+        """Opens one endpoint per listening address on the running loop."""
+        loop = asyncio.get_running_loop()
+        endpoints = []
+        try:
+            for host, port, options in self.listen:
+                endpoints.append(await loop.create_datagram_endpoint(
+                    lambda: OwlDNSProtocol(resolver, resolver.profiler),
+                    sock=self.listen_socket(host, port, options)))
+        except Exception:
+            for transport, _ in endpoints:
+                transport.close()
+            raise
+        return endpoints
 
     async def start(self):
-        """Starts the async UDP DNS server."""
+        """Starts the async UDP DNS server and serves until stopped or cancelled."""
         loop = asyncio.get_running_loop()
-        logger.info("OwlDNS starting on %s:%d...", self.host, self.port)
+        logger.info("OwlDNS starting on %s (%d thread%s)...",
+                    ", ".join(f"[{h}]:{p}" if ":" in h else f"{h}:{p}" for h, p, _ in self.listen),
+                    self.threads, "s" if self.threads > 1 else "")
+        self.stopping = asyncio.Event()
 
-        # Create the UDP endpoint
-        self.transport, self.protocol = await loop.create_datagram_endpoint(
-            lambda: OwlDNSProtocol(self.resolver),
-            local_addr=(self.host, self.port)
-        )
+        snapshot = self.resolver.cache.config.get("snapshot")
+        if snapshot:
+            logger.info("Restored %d cache entries from %s",
+                        load_snapshot(self.resolver.cache, snapshot), snapshot)
+
+        self.inherited = inherited_sockets()
+        if self.inherited:
+            logger.info("Took over %d listening socket(s)", len(self.inherited))
+
+        # Create the UDP endpoints
+        for transport, protocol in await self.bind(self.resolver):
+            self.transports.append(transport)
+            self.protocols.append(protocol)
+
+        # Worker threads run the same loop implementation as the main thread
+        for index in range(1, self.threads):
+            ready = threading.Event()
+            worker = threading.Thread(target=self.serve_worker, args=(type(loop), ready),
+                                      name=f"owldns-worker-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+            await asyncio.to_thread(ready.wait)
+
+        # Sockets of listeners dropped from the config since the handoff
+        for sock in self.inherited:
+            sock.close()
+        self.inherited.clear()
+
+        signals = [(signal.SIGTERM, self.stop)]
+        if hasattr(signal, "SIGUSR2"):
+            signals.append((signal.SIGUSR2, lambda: asyncio.ensure_future(self.handoff())))
+        if self.profiler and hasattr(signal, "SIGUSR1"):
+            signals.append((signal.SIGUSR1, self.dump_profile))
+        for signum, handler in signals:
+            loop.add_signal_handler(signum, handler)
 
         try:
-            # Keep the server running until cancelled
-            await asyncio.Future()
+            if self.admin:
+                await self.admin.start()
+            notify_ready()
+            # Keep the server running until stopped or cancelled
+            await self.stopping.wait()
         finally:
-            if self.transport:
-                self.transport.close()
+            for signum, _ in signals:
+                loop.remove_signal_handler(signum)
+            await self.shutdown()
+
+    def stop(self) -> None:
+        """Begins a graceful shutdown (bound to SIGTERM)."""
+        if self.stopping:
+            self.stopping.set()
+
+    async def shutdown(self) -> None:
+        """
+        Stops accepting queries, lets in-flight ones finish within drain_timeout,
+        then releases everything and flushes the latency histograms and cache snapshot.
+        """
+        if self.admin:
+            self.admin.close()
+        abandoned = await self.drain(self.drain_timeout)
+        if abandoned:
+            logger.warning("Abandoned %d in-flight queries after %.1fs", abandoned, self.drain_timeout)
+        self.stop_workers()
+        for transport in self.transports:
+            transport.close()
+        self.resolver.close()
+
+        self.dump_profile()
+        cache = self.resolver.cache
+        logger.info("Cache at shutdown: %d entries, %d hits, %d misses",
+                    len(cache), cache.hits, cache.misses)
+        snapshot = cache.config.get("snapshot")
+        # After a handoff the successor has already loaded the snapshot we wrote
+        if snapshot and not self.handed_off:
+            try:
+                logger.info("Saved %d cache entries to %s", save_snapshot(cache, snapshot), snapshot)
+            except OSError as e:
+                logger.error("Error saving cache snapshot %s: %s", snapshot, e)
+
+    async def drain(self, timeout: float) -> int:
+        """Drains every endpoint on every loop concurrently. Returns the number of abandoned queries."""
+        waits = [protocol.drain(timeout) for protocol in self.protocols]
+        for worker_loop, protocols in zip(self.worker_loops, self.worker_protocols):
+            for protocol in protocols:
+                waits.append(asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(protocol.drain(timeout), worker_loop)))
+        results = await asyncio.gather(*waits, return_exceptions=True)
+        return sum(r for r in results if isinstance(r, int))
+
+    async def handoff(self) -> bool:
+        """
+        Zero-downtime restart (bound to SIGUSR2). Starts a new process with the
+        same command line, passing it the listening sockets. Both processes read
+        the same sockets until the new one reports ready, then this one drains
+        and exits. On failure this process keeps serving. Returns True on success.
+        """
+        if self.handing_off or (self.stopping and self.stopping.is_set()):
+            logger.warning("Ignoring handoff request: %s",
+                           "a handoff is in progress" if self.handing_off else "shutting down")
+            return False
+        transports = self.transports + [p.transport for ps in self.worker_protocols for p in ps]
+        fds = [t.get_extra_info("socket").fileno() for t in transports if t and not t.is_closing()]
+        if not fds:
+            return False
+
+        self.handing_off = True
+        # The successor binds the admin endpoint itself
+        if self.admin:
+            self.admin.close()
+        ok = False
+        try:
+            ok = await self._handoff(fds)
+        except Exception as e:
+            logger.error("Handoff failed: %s", e)
+        finally:
+            # On success this process is stopping, so later requests are still ignored
+            self.handing_off = False
+            if not ok and self.admin:
+                try:
+                    await self.admin.start()
+                except OSError as e:
+                    logger.error("Error restarting the admin endpoint: %s", e)
+        return ok
+
+    async def _handoff(self, fds: list[int]) -> bool:
+        """Starts the successor on fds and waits for it to become ready."""
+        # The successor loads a fresh cache snapshot
+        snapshot = self.resolver.cache.config.get("snapshot")
+        if snapshot:
+            try:
+                save_snapshot(self.resolver.cache, snapshot)
+            except OSError as e:
+                logger.error("Error saving cache snapshot %s; keeping this process: %s", snapshot, e)
+                return False
+
+        read_fd, write_fd = os.pipe()
+        env = {**os.environ, LISTEN_FDS_ENV: ",".join(map(str, fds)), READY_FD_ENV: str(write_fd)}
+        logger.info("Handing %d socket(s) to a new process...", len(fds))
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        try:
+            process = subprocess.Popen(sys.orig_argv, env=env, pass_fds=(*fds, write_fd))
+        except OSError as e:
+            logger.error("Handoff failed to start a new process: %s", e)
+            os.close(read_fd)
+            os.close(write_fd)
+            return False
+        os.close(write_fd)
+
+        def on_ready() -> None:
+            if not ready.done():
+                ready.set_result(os.read(read_fd, 1) == b"1")
+
+        loop.add_reader(read_fd, on_ready)
+        try:
+            # EOF without a byte means the new process exited before serving
+            ok = await asyncio.wait_for(ready, timeout=30)
+        except asyncio.TimeoutError:
+            ok = False
+        finally:
+            loop.remove_reader(read_fd)
+            os.close(read_fd)
+
+        if not ok:
+            logger.error("New process %d did not become ready; keeping this one", process.pid)
+            if process.poll() is None:
+                process.terminate()
+            return False
+
+        logger.info("New process %d is serving; draining this one", process.pid)
+        self.handed_off = True
+        self.stop()
+        return True
+
+    def serve_worker(self, loop_factory, ready: threading.Event) -> None:
+        """Thread body: serves queries on its own event loop and SO_REUSEPORT sockets."""
+        loop = loop_factory()
+        asyncio.set_event_loop(loop)
+        resolver = self.resolver.clone()
+        if self.profiler:
+            # Histogram increments are unsynchronised, so each loop keeps its own
+            resolver.profiler = self.profiler.fork()
+        try:
+            endpoints = loop.run_until_complete(self.bind(resolver))
+        except Exception as e:
+            logger.error("Worker %s failed to bind: %s", threading.current_thread().name, e)
+            loop.close()
+            ready.set()
+            return
+
+        self.worker_loops.append(loop)
+        self.worker_protocols.append([protocol for _, protocol in endpoints])
+        ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            for transport, _ in endpoints:
+                transport.close()
+            resolver.close()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    def stop_workers(self) -> None:
+        """Stops the worker event loops and waits for their threads."""
+        for worker_loop in self.worker_loops:
+            worker_loop.call_soon_threadsafe(worker_loop.stop)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        self.workers.clear()
+        self.worker_loops.clear()
+        self.worker_protocols.clear()
+
+    def dump_profile(self) -> None:
+        """Logs the per-stage latency histograms (bound to SIGUSR1 when profiling)."""
+        if self.profiler:
+            logger.info("Stage latency (log2 buckets, upper bounds):\n%s", self.profiler.format())
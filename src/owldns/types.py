@@ -11,3 +11,103 @@ class UpstreamServer(TypedDict):
     address: str | None
     group: str | None
     proxy: str | None
+
+
+class UpstreamGroup(TypedDict, total=False):
+    """
+    Routing settings for a named upstream group ([run.groups.<name>] in config).
+    domains:  Domain suffixes routed to this group (e.g. "corp.example.com").
+    strategy: "sequential" (in order), "random" (shuffled) or "race" (all at once, first answer wins).
+    timeout:  Per-upstream query timeout in seconds.
+    """
+    domains: list[str]
+    strategy: str
+    timeout: float
+
+
+class View(TypedDict, total=False):
+    """
+    A split-horizon view ([[run.views]] in config).
+    name:       View name, also used to scope cached answers.
+    networks:   Client CIDRs (or EDNS Client Subnet prefixes) served by this view.
+    records:    Records answered only to this view's clients; global records still apply.
+    hosts_file: Hosts-style file loaded into records at startup.
+    group:      Upstream group for misses from this view's clients.
+    """
+    name: str
+    networks: list[str]
+    records: DNSDict
+    hosts_file: str
+    group: str
+
+
+class CacheConfig(TypedDict, total=False):
+    """
+    Answer cache settings ([run.cache] in config).
+    size:                Maximum number of cached answers (0 disables the cache).
+    min_ttl / max_ttl:   Bounds applied to positive answer TTLs, in seconds.
+    negative_max_ttl:    Upper bound for NXDOMAIN/NODATA TTLs (RFC 2308), in seconds.
+    aggressive_nxdomain: Answer NXDOMAIN for names below a cached NXDOMAIN (RFC 8020).
+    shards:              Split the cache into this many locked shards (multi-threaded mode).
+    snapshot:            File the cache is saved to on shutdown and restored from on start.
+    """
+    size: int
+    min_ttl: int
+    max_ttl: int
+    negative_max_ttl: int
+    aggressive_nxdomain: bool
+    shards: int
+    snapshot: str
+
+
+class PolicySource(TypedDict, total=False):
+    """
+    One blocklist source ([[run.policy.sources]] in config).
+    file:       Path of the list.
+    format:     "domains" (one per line), "hosts" (hosts-style) or "rpz" (RPZ zone file).
+    action:     "nxdomain", "nodata", "redirect" or "passthru" for domains/hosts lists.
+    redirect:   Answer IPs for the "redirect" action.
+    subdomains: Whether listed domains also cover their subdomains (default true).
+    """
+    file: str
+    format: str
+    action: str
+    redirect: list[str]
+    subdomains: bool
+
+
+class PolicyConfig(TypedDict, total=False):
+    """
+    Response policy settings ([run.policy] in config).
+    sources: Blocklist sources, loaded in order; later rules override earlier ones.
+    bloom:   Put a Bloom filter (~8.4 bits per name) in front of the index to speed up misses.
+    """
+    sources: list[PolicySource]
+    bloom: bool
+
+
+class AdminConfig(TypedDict, total=False):
+    """
+    Runtime admin endpoint ([run.admin] in config). Exactly one of:
+    socket:  Path of a Unix socket to listen on.
+    address: "host:port" to listen on over TCP; the host must be a loopback address.
+    """
+    socket: str
+    address: str
+
+
+class ListenConfig(TypedDict, total=False):
+    """
+    One listening socket ([[run.listen]] in config; a plain "host:port" string also works).
+    address:  "host:port", "[v6addr]:port" or a bare host (uses the [run] port).
+    rcvbuf:   SO_RCVBUF in bytes, so bursts queue in the kernel instead of being dropped.
+    sndbuf:   SO_SNDBUF in bytes.
+    freebind: Set IP_FREEBIND to bind an address that is not (yet) configured (Linux).
+    v6only:   Set IPV6_V6ONLY on an IPv6 socket. Unset keeps the OS default (dual-stack
+              on Linux), except that "[::]" becomes v6-only next to "0.0.0.0" on its port.
+    """
+    address: str
+    rcvbuf: int
+    sndbuf: int
+    freebind: bool
+    v6only: bool
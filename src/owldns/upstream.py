@@ -0,0 +1,371 @@
+from __future__ import annotations
+import abc
+import asyncio
+import collections
+import itertools
+import secrets
+import ssl as ssl_lib
+import time
+from owldns.proxy import open_proxy_connection
+from owldns.utils import logger, parse_upstream_address, redact_proxy
+
+
+def question_section(message: bytes) -> bytes:
+    """
+    Returns the raw question section (name, type and class) of a message with
+    exactly one question. Raises ValueError for anything else.
+    """
+    if message[4:6] != b"\x00\x01":
+        raise ValueError("expected exactly one question")
+    pos = 12
+    try:
+        while length := message[pos]:
+            if length & 0xC0:
+                raise ValueError("compressed name in question")
+            pos += length + 1
+    except IndexError:
+        raise ValueError("truncated question") from None
+    if pos + 5 > len(message):
+        raise ValueError("truncated question")
+    return message[12:pos + 5]
+
+
+# Lowercase ASCII letters, for randomize_case
+LETTERS = frozenset(range(ord("a"), ord("z") + 1))
+
+
+def randomize_case(question: bytes) -> bytes:
+    """
+    Flips the case of each letter in a raw question name at random (DNS 0x20),
+    adding one bit of entropy per letter that a spoofed answer must also guess.
+    """
+    bits = secrets.randbits(len(question))
+    out = bytearray(question)
+    pos = 0
+    while length := out[pos]:
+        for i in range(pos + 1, pos + 1 + length):
+            if (bits >> i) & 1 and (out[i] | 0x20) in LETTERS:
+                out[i] ^= 0x20
+        pos += length + 1
+    return bytes(out)
+
+
+def response_matches(packet: bytes, query_id: bytes, question: bytes) -> bool:
+    """
+    Checks, without parsing, that packet answers a query: a response (QR set)
+    with the same ID and a byte-identical question (so case must match too).
+    """
+    end = 12 + len(question)
+    return (packet[:2] == query_id and len(packet) >= end and bool(packet[2] & 0x80)
+            and packet[4:6] == b"\x00\x01" and packet[12:end] == question)
+
+
+class _PipelinedConnection(abc.ABC):
+    """
+    A single persistent stream to an upstream, carrying many outstanding queries.
+    Subclasses define how a query is framed and how responses are matched back.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 health: UpstreamHealth | None = None):
+        self.reader = reader
+        self.writer = writer
+        # Counts responses dropped for not matching their query
+        self.health: UpstreamHealth | None = health
+        self.closed: bool = False
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    @abc.abstractmethod
+    async def query(self, data: bytes, timeout: float) -> bytes:
+        """Sends one query and returns its answer."""
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                await self._read_response()
+        except Exception as e:  # EOF, reset or protocol error: the connection is done
+            self._fail_pending(ConnectionError(f"Upstream connection lost: {e!r}"))
+        finally:
+            self.closed = True
+            self.writer.close()
+
+    @abc.abstractmethod
+    async def _read_response(self) -> None:
+        """Reads one response from the stream and resolves the query it answers."""
+
+    @abc.abstractmethod
+    def _fail_pending(self, exc: Exception) -> None:
+        """Fails every query still waiting for an answer."""
+
+    def _mismatch(self, reason: str) -> None:
+        if self.health is not None:
+            self.health.mismatched += 1
+        logger.debug("Dropping %s stream response", reason)
+
+    def close(self) -> None:
+        self.closed = True
+        self._reader_task.cancel()
+        self._fail_pending(ConnectionError("Upstream connection closed"))
+        self.writer.close()
+
+
+class DNSStreamConnection(_PipelinedConnection):
+    """
+    Length-prefixed DNS over TCP/TLS (RFC 7766 / RFC 7858).
+    Responses may arrive out of order, so they are matched by transaction ID
+    and question. Each in-flight query gets a connection-unique ID which is
+    restored on the answer.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 health: UpstreamHealth | None = None):
+        self.pending: dict[int, tuple[asyncio.Future, bytes, bytes]] = {}
+        super().__init__(reader, writer, health)
+
+    async def query(self, data: bytes, timeout: float) -> bytes:
+        question = question_section(data)
+        # Unpredictable, like the UDP path: proxied plain-TCP answers cross untrusted hops
+        qid = secrets.randbits(16)
+        while qid in self.pending:
+            qid = secrets.randbits(16)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[qid] = (future, data[:2], question)
+        try:
+            self.writer.write(len(data).to_bytes(2, "big") +
+                              qid.to_bytes(2, "big") + data[2:])
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(qid, None)
+
+    async def _read_response(self) -> None:
+        length = int.from_bytes(await self.reader.readexactly(2), "big")
+        message = await self.reader.readexactly(length)
+        qid = int.from_bytes(message[:2], "big")
+        entry = self.pending.get(qid)
+        if entry is None:
+            self._mismatch("unsolicited")
+            return
+        future, original_id, question = entry
+        if not response_matches(message, message[:2], question):
+            # Leave the query pending: its real answer may still follow
+            self._mismatch("mismatched")
+            return
+        del self.pending[qid]
+        if not future.done():
+            future.set_result(original_id + message[2:])
+
+    def _fail_pending(self, exc: Exception) -> None:
+        for future, _, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+
+class DoHConnection(_PipelinedConnection):
+    """
+    DNS-over-HTTPS (RFC 8484) using HTTP/1.1 keep-alive with request pipelining.
+    HTTP/1.1 answers strictly in request order, so responses are matched FIFO.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 authority: str, path: str, health: UpstreamHealth | None = None):
+        self.pending: collections.deque[tuple[asyncio.Future, bytes, bytes]] = collections.deque()
+        self._head: bytes = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {authority}\r\n"
+            "Content-Type: application/dns-message\r\n"
+            "Accept: application/dns-message\r\n"
+        ).encode()
+        super().__init__(reader, writer, health)
+
+    async def query(self, data: bytes, timeout: float) -> bytes:
+        question = question_section(data)
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((future, data[:2], question))
+        self.writer.write(self._head + b"Content-Length: %d\r\n\r\n" % len(data) + data)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # A timed-out slot breaks FIFO matching for everything behind it
+            self.close()
+            raise
+
+    async def _read_response(self) -> None:
+        status_line = await self.reader.readuntil(b"\r\n")
+        status = int(status_line.split(b" ", 2)[1])
+        headers: dict[bytes, bytes] = {}
+        while (line := await self.reader.readuntil(b"\r\n")) != b"\r\n":
+            key, _, value = line.partition(b":")
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get(b"transfer-encoding", b"").lower() == b"chunked":
+            body = b""
+            while size := int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                body += await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+            await self.reader.readuntil(b"\r\n")
+        else:
+            body = await self.reader.readexactly(int(headers.get(b"content-length", b"0")))
+
+        future, query_id, question = self.pending.popleft()
+        if not future.done():
+            if status != 200:
+                future.set_exception(RuntimeError(f"DoH HTTP status {status}"))
+            elif response_matches(body, query_id, question):
+                future.set_result(body)
+            else:
+                # HTTP answers are strictly ordered, so this slot gets no other answer
+                self._mismatch("mismatched")
+                future.set_exception(RuntimeError("DoH response does not match its query"))
+
+        if headers.get(b"connection", b"").lower() == b"close":
+            raise ConnectionResetError("server closed keep-alive connection")
+
+    def _fail_pending(self, exc: Exception) -> None:
+        for future, _, _ in self.pending:
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+
+class StreamUpstream:
+    """
+    A pool of persistent, pipelined connections to one TCP/TLS/HTTPS upstream,
+    optionally tunnelled through a SOCKS5 or HTTP CONNECT proxy.
+    Connections are opened lazily and only re-established after they fail,
+    so the proxy, TCP and TLS handshakes are paid once per pool slot rather than per query.
+    """
+
+    def __init__(self, scheme: str, host: str, port: int, path: str = "",
+                 server_name: str | None = None, pool_size: int = 2,
+                 ssl: ssl_lib.SSLContext | None | bool = True, proxy: str | None = None,
+                 health: UpstreamHealth | None = None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.path = path
+        self.server_name = server_name or host
+        self.proxy = proxy
+        self.health = health
+        if ssl is True and scheme == "tcp":
+            ssl = None
+        elif ssl is True:
+            # One context per upstream, shared by every pooled connection
+            ssl = ssl_lib.create_default_context()
+            ssl.set_alpn_protocols(["http/1.1"] if scheme == "https" else ["dot"])
+        self.ssl: ssl_lib.SSLContext | None = ssl or None
+        self._slots: list[_PipelinedConnection | None] = [None] * max(1, pool_size)
+        self._locks = [asyncio.Lock() for _ in self._slots]
+        self._next = itertools.cycle(range(len(self._slots)))
+
+    @classmethod
+    def from_address(cls, address: str, proxy: str | None = None, **kwargs) -> StreamUpstream:
+        """
+        Builds a pool for an upstream address. Plain (UDP) upstreams are only
+        accepted together with a proxy, in which case they are queried over TCP.
+        """
+        scheme, host, port, path, server_name = parse_upstream_address(address)
+        if scheme == "udp":
+            if not proxy:
+                raise ValueError(f"{address} is not a stream upstream")
+            scheme = "tcp"
+        return cls(scheme, host, port, path, server_name, proxy=proxy, **kwargs)
+
+    async def _open(self) -> _PipelinedConnection:
+        server_hostname = self.server_name if self.ssl else None
+        if self.proxy:
+            reader, writer = await open_proxy_connection(self.proxy, self.host, self.port)
+            if self.ssl:
+                await writer.start_tls(self.ssl, server_hostname=server_hostname)
+        else:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl, server_hostname=server_hostname)
+        logger.debug("Opened %s connection to %s:%d%s", self.scheme, self.host, self.port,
+                     f" via {redact_proxy(self.proxy)}" if self.proxy else "")
+        if self.scheme == "https":
+            authority = self.server_name if self.port == 443 else f"{self.server_name}:{self.port}"
+            return DoHConnection(reader, writer, authority, self.path, self.health)
+        return DNSStreamConnection(reader, writer, self.health)
+
+    async def _connection(self) -> _PipelinedConnection:
+        index = next(self._next)
+        conn = self._slots[index]
+        if conn is not None and not conn.closed:
+            return conn
+        async with self._locks[index]:
+            conn = self._slots[index]
+            if conn is None or conn.closed:
+                conn = self._slots[index] = await self._open()
+            return conn
+
+    async def query(self, data: bytes, timeout: float = 2.0) -> bytes:
+        """Sends a DNS message over a pooled connection and awaits its answer."""
+        conn = await asyncio.wait_for(self._connection(), timeout)
+        return await conn.query(data, timeout)
+
+    def close(self) -> None:
+        for conn in self._slots:
+            if conn is not None:
+                conn.close()
+        self._slots = [None] * len(self._slots)
+
+
+class UpstreamHealth:
+    """
+    Running counters for one upstream, reported by the admin API.
+    Updates are unsynchronised, so each event loop keeps its own and merged() combines them.
+    """
+    __slots__ = ("queries", "failures", "consecutive_failures", "rtt_ms", "last_error",
+                 "failed_at", "mismatched")
+
+    def __init__(self):
+        self.queries: int = 0
+        self.failures: int = 0
+        self.consecutive_failures: int = 0
+        # Exponentially weighted moving average of successful round trips
+        self.rtt_ms: float | None = None
+        self.last_error: str | None = None
+        self.failed_at: float = 0.0
+        # Responses dropped for not matching their query (wrong ID, question or case)
+        self.mismatched: int = 0
+
+    def success(self, rtt_ms: float) -> None:
+        self.queries += 1
+        self.consecutive_failures = 0
+        self.rtt_ms = rtt_ms if self.rtt_ms is None else 0.8 * self.rtt_ms + 0.2 * rtt_ms
+
+    def failure(self, error: Exception) -> None:
+        self.queries += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = str(error)
+        self.failed_at = time.monotonic()
+
+    @classmethod
+    def merged(cls, parts: list[UpstreamHealth]) -> UpstreamHealth:
+        """Combines the counters several event loops kept for one upstream."""
+        total = cls()
+        for part in parts:
+            total.queries += part.queries
+            total.failures += part.failures
+            total.mismatched += part.mismatched
+            total.consecutive_failures = max(total.consecutive_failures, part.consecutive_failures)
+            if part.last_error and part.failed_at >= total.failed_at:
+                total.last_error, total.failed_at = part.last_error, part.failed_at
+        # Round-trip averages weighted by each loop's successful queries
+        rtts = [(part.rtt_ms, part.queries - part.failures) for part in parts if part.rtt_ms is not None]
+        weight = sum(w for _, w in rtts)
+        if rtts:
+            total.rtt_ms = sum(r * w for r, w in rtts) / weight if weight else rtts[0][0]
+        return total
+
+    def as_dict(self) -> dict:
+        return {
+            "queries": self.queries,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "rtt_ms": round(self.rtt_ms, 3) if self.rtt_ms is not None else None,
+            "last_error": self.last_error,
+            "mismatched": self.mismatched,
+        }
@@ -3,11 +3,18 @@ import logging
 import re
 import sys
 import tomllib
+from urllib.parse import unquote, urlsplit
 from owldns.types import DNSDict, UpstreamServer
 
 # Global logger for the owldns package
 logger = logging.getLogger("owldns")
 
+# Default ports per upstream scheme
+DEFAULT_PORTS: dict[str, int] = {"udp": 53, "tls": 853, "https": 443}
+
+# Default ports per proxy scheme
+PROXY_PORTS: dict[str, int] = {"socks5": 1080, "http": 8080}
+
 
 def setup_logger(level: str | int = "INFO") -> logging.Logger:
     """
@@ -93,7 +100,78 @@ def parse_upstream_server(server_str: str) -> UpstreamServer:
     )
     match = re.search(pattern, server_str)
     if match:
-        # Use cast or explicit return to satisfy TypedDict
-        return match.groupdict()  # type: ignore
+        try:
+            parse_upstream_address(match["address"])
+            if match["proxy"]:
+                parse_proxy_address(match["proxy"])
+        except ValueError as e:
+            # The raw string may carry proxy credentials
+            logger.error("Invalid upstream %s%s: %s", match["address"],
+                         f" via {redact_proxy(match['proxy'])}" if match["proxy"] else "", e)
+        else:
+            # Use cast or explicit return to satisfy TypedDict
+            return match.groupdict()  # type: ignore
 
     return {"address": None, "group": None, "proxy": None}
+
+
+def parse_upstream_address(address: str) -> tuple[str, str, int, str, str]:
+    """
+    Splits an upstream address into (scheme, host, port, path, server_name).
+    Supported forms:
+      1.1.1.1                                  plain UDP on port 53
+      udp://127.0.0.1:5300                     plain UDP on another port
+      tls://1.1.1.1[:853][#cloudflare-dns.com] DNS-over-TLS (RFC 7858)
+      https://dns.google[:443]/dns-query       DNS-over-HTTPS (RFC 8484)
+    The optional '#name' fragment overrides the TLS server name (SNI).
+    """
+    if "://" not in address:
+        return "udp", address, DEFAULT_PORTS["udp"], "", ""
+
+    parts = urlsplit(address)
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        raise ValueError(f"Unsupported upstream scheme: {scheme}")
+    if not parts.hostname:
+        raise ValueError(f"Missing upstream host in {address}")
+
+    port = parts.port or DEFAULT_PORTS[scheme]
+    path = parts.path or ("/dns-query" if scheme == "https" else "")
+    server_name = parts.fragment or parts.hostname
+    return scheme, parts.hostname, port, path, server_name
+
+
+def parse_listen_address(address: str, default_port: int) -> tuple[str, int]:
+    """Splits a listen address ("host:port", "[v6addr]:port" or a bare host) into (host, port)."""
+    if address.count(":") > 1 and not address.startswith("["):
+        # A bare IPv6 address
+        return address, default_port
+    parts = urlsplit(f"//{address}")
+    if not parts.hostname:
+        raise ValueError(f"Missing listen host in {address}")
+    return parts.hostname, parts.port or default_port
+
+
+def parse_proxy_address(proxy: str) -> tuple[str, str, int, str | None, str | None]:
+    """
+    Splits a proxy address into (scheme, host, port, username, password).
+    Format: [socks5://|http://][user:pass@]host[:port]; a bare host:port means SOCKS5.
+    Credentials are percent-decoded, so "p%40ss" configures the password "p@ss".
+    """
+    parts = urlsplit(proxy if "://" in proxy else f"socks5://{proxy}")
+    scheme = parts.scheme.lower()
+    if scheme not in PROXY_PORTS:
+        raise ValueError(f"Unsupported proxy scheme: {scheme}")
+    if not parts.hostname:
+        raise ValueError(f"Missing proxy host in {redact_proxy(proxy)}")
+    return (scheme, parts.hostname, parts.port or PROXY_PORTS[scheme],
+            unquote(parts.username) if parts.username is not None else None,
+            unquote(parts.password) if parts.password is not None else None)
+
+
+def redact_proxy(proxy: str | None) -> str | None:
+    """Returns the proxy address without its user:pass@ credentials, for logs and reports."""
+    if not proxy or "@" not in proxy:
+        return proxy
+    scheme, sep, rest = proxy.rpartition("://")
+    return f"{scheme}{sep}{rest.rpartition('@')[2]}"
@@ -0,0 +1,63 @@
+from __future__ import annotations
+import ipaddress
+from dnslib import DNSRecord, QTYPE
+from owldns.index import PrefixIndex, RecordIndex
+from owldns.types import View
+
+# EDNS option code for Client Subnet (RFC 7871)
+ECS_OPTION_CODE = 8
+
+
+def client_subnet(request: DNSRecord) -> str | None:
+    """
+    Returns the address carried in the request's EDNS Client Subnet option, if any.
+    A source prefix length of 0 means the client opted out (RFC 7871), so it yields None.
+    """
+    for rr in request.ar:
+        if rr.rtype != QTYPE.OPT:
+            continue
+        for option in rr.rdata:
+            if option.code != ECS_OPTION_CODE or len(option.data) < 4:
+                continue
+            family = int.from_bytes(option.data[:2], "big")
+            size = 4 if family == 1 else 16 if family == 2 else 0
+            if not size or option.data[2] == 0:
+                return None
+            address = option.data[4:4 + size].ljust(size, b"\0")
+            return str(ipaddress.ip_address(address))
+    return None
+
+
+class ViewTable:
+    """Selects the split-horizon view for a query by client address or ECS."""
+
+    def __init__(self, views: list[View] | None = None, ecs_trusted: list[str] | None = None):
+        self.views: dict[str, View] = {}
+        self.networks: PrefixIndex[View] = PrefixIndex()
+        # Sources (e.g. front-end resolvers) whose ECS option is believed;
+        # anyone else could pick any view by forging one
+        self.ecs_trusted: PrefixIndex[bool] = PrefixIndex(
+            {network: True for network in ecs_trusted or []})
+        # Compiled per-view local records, keyed by view name
+        self.records: dict[str, RecordIndex] = {}
+        for view in views or []:
+            if view["name"] in self.views:
+                raise ValueError(f"Duplicate view name: {view['name']}")
+            self.views[view["name"]] = view
+            if view.get("records"):
+                self.records[view["name"]] = RecordIndex(view["records"])
+            for network in view.get("networks", []):
+                self.networks.add(network, view)
+
+    def select(self, request: DNSRecord, addr: tuple[str, int] | None) -> View | None:
+        """
+        Returns the view whose networks best match the client.
+        An EDNS Client Subnet option takes precedence over the packet source,
+        but only when the packet comes from an ecs_trusted network.
+        """
+        if not self.views or addr is None:
+            return None
+        client = addr[0]
+        if request.ar and self.ecs_trusted.match(client):
+            client = client_subnet(request) or client
+        return self.networks.match(client)
@@ -0,0 +1,204 @@
+import pytest
+from unittest.mock import patch, AsyncMock
+from dnslib import DNSRecord, RR, QTYPE, RCODE, A, SOA
+from owldns.cache import DNSCache, ShardedDNSCache, response_ttl
+from owldns.resolver import Resolver
+
+
+def answer(name: str, ip: str = "10.0.0.1", ttl: int = 300) -> DNSRecord:
+    reply = DNSRecord.question(name).reply()
+    reply.add_answer(RR(name, QTYPE.A, rdata=A(ip), ttl=ttl))
+    return reply
+
+
+def nxdomain(name: str, soa_ttl: int = 900, minimum: int = 60) -> DNSRecord:
+    reply = DNSRecord.question(name).reply()
+    reply.header.rcode = RCODE.NXDOMAIN
+    reply.add_auth(RR("test", QTYPE.SOA, ttl=soa_ttl,
+                      rdata=SOA("ns.test", "admin.test", (1, 3600, 600, 86400, minimum))))
+    return reply
+
+
+def test_response_ttl():
+    assert response_ttl(answer("a.test", ttl=120), {}) == 120
+    assert response_ttl(answer("a.test", ttl=10), {"min_ttl": 30}) == 30
+    # RFC 2308: negative TTL is min(SOA TTL, SOA MINIMUM)
+    assert response_ttl(nxdomain("a.test"), {}) == 60
+    assert response_ttl(nxdomain("a.test", soa_ttl=20), {}) == 20
+    assert response_ttl(nxdomain("a.test", minimum=7200), {"negative_max_ttl": 600}) == 600
+    # Denials without an SOA are not cached
+    reply = DNSRecord.question("a.test").reply()
+    reply.header.rcode = RCODE.NXDOMAIN
+    assert response_ttl(reply, {}) is None
+
+
+def test_cache_hit_restamps_request():
+    cache = DNSCache()
+    stored = answer("a.test")
+    cache.put(("", "a.test", QTYPE.A), stored, stored.pack())
+
+    request = DNSRecord.question("A.Test")
+    hit = DNSRecord.parse(cache.get(("", "a.test", QTYPE.A), request))
+    assert hit.header.id == request.header.id
+    assert str(hit.q.qname) == "A.Test."
+    assert str(hit.rr[0].rdata) == "10.0.0.1"
+    assert cache.get(("office", "a.test", QTYPE.A), request) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_lru_eviction():
+    cache = DNSCache({"size": 2})
+    for name in ("a.test", "b.test", "c.test"):
+        cache.put(("", name, QTYPE.A), answer(name), answer(name).pack())
+    assert len(cache) == 2
+    assert ("", "a.test", QTYPE.A) not in cache.entries
+
+
+@pytest.mark.asyncio
+async def test_resolve_caches_nxdomain_for_all_qtypes():
+    resolver = Resolver(records={}, upstreams=[{"address": "1.1.1.1", "group": None, "proxy": None}])
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = nxdomain("gone.test").pack()
+        for qtype in ("A", "AAAA", "A"):
+            response = DNSRecord.parse(await resolver.resolve(
+                DNSRecord.question("gone.test", qtype).pack()))
+            assert response.header.rcode == RCODE.NXDOMAIN
+        mock_forward.assert_awaited_once()
+
+        # Without aggressive mode, subdomains still go upstream
+        await resolver.resolve(DNSRecord.question("x.gone.test").pack())
+        assert mock_forward.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_resolve_aggressive_nxdomain_cut():
+    resolver = Resolver(records={}, upstreams=[{"address": "1.1.1.1", "group": None, "proxy": None}],
+                        cache={"aggressive_nxdomain": True})
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = nxdomain("gone.test").pack()
+        await resolver.resolve(DNSRecord.question("gone.test").pack())
+        for label in ("a1b2", "zz9.c3d4"):
+            response = DNSRecord.parse(await resolver.resolve(
+                DNSRecord.question(f"{label}.gone.test").pack()))
+            assert response.header.rcode == RCODE.NXDOMAIN
+        mock_forward.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_resolve_known_nonexistent_suffix():
+    resolver = Resolver(records={}, nxdomain=["invalid", "flood.example"])
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        for name in ("x7f3.flood.example", "foo.invalid"):
+            response = DNSRecord.parse(await resolver.resolve(DNSRecord.question(name).pack()))
+            assert response.header.rcode == RCODE.NXDOMAIN
+        mock_forward.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_resolve_cache_scoped_per_view():
+    resolver = Resolver(records={}, upstreams=[{"address": "1.1.1.1", "group": None, "proxy": None}],
+                        views=[{"name": "office", "networks": ["10.0.0.0/8"]}])
+    data = DNSRecord.question("a.test").pack()
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = answer("a.test").pack()
+        await resolver.resolve(data, ("10.1.1.1", 5000))
+        await resolver.resolve(data, ("10.1.1.2", 5000))
+        assert mock_forward.await_count == 1
+        await resolver.resolve(data, ("192.0.2.1", 5000))
+        assert mock_forward.await_count == 2
+
+
+def test_sharded_cache_threads():
+    import threading
+    cache = ShardedDNSCache({"size": 4000}, shards=4)
+
+    def worker(offset):
+        for i in range(200):
+            name = f"n{offset}-{i}.test"
+            cache.put(("", name, QTYPE.A), answer(name), answer(name).pack())
+            assert cache.get(("", name, QTYPE.A), DNSRecord.question(name)) is not None
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) == 800
+    assert cache.hits == 800 and cache.misses == 0
+
+
+def test_sharded_cache_aggressive_nxdomain():
+    cache = ShardedDNSCache({}, shards=8)
+    cache.put(("", "gone.test", QTYPE.A), nxdomain("gone.test"), nxdomain("gone.test").pack())
+    request = DNSRecord.question("a.b.gone.test")
+    assert cache.get_nxdomain("", "a.b.gone.test", request) is None
+    assert cache.get_nxdomain("", "a.b.gone.test", request, aggressive=True) is not None
+
+
+def test_sharded_cache_renders_outside_the_shard_lock():
+    cache = ShardedDNSCache({}, shards=4)
+    cache.put(("", "a.test", QTYPE.A), answer("a.test"), answer("a.test").pack())
+    cache.put(("", "gone.test", QTYPE.A), nxdomain("gone.test"), nxdomain("gone.test").pack())
+    render = DNSCache.render
+
+    def unlocked_render(entry, request, now):
+        assert not any(lock.locked() for lock in cache.locks)
+        return render(entry, request, now)
+
+    with patch.object(DNSCache, "render", side_effect=unlocked_render) as mock_render:
+        assert cache.get(("", "a.test", QTYPE.A), DNSRecord.question("a.test")) is not None
+        assert cache.get_nxdomain("", "gone.test", DNSRecord.question("gone.test")) is not None
+        assert mock_render.call_count == 2
+    assert cache.hits == 2
+
+
+def test_cache_flush_name_and_suffix():
+    cache = DNSCache()
+    for name in ("a.test", "b.test", "x.corp.test", "corp.test"):
+        cache.put(("", name, QTYPE.A), answer(name), answer(name).pack())
+
+    cache.flush(name="A.Test.")
+    assert cache.get(("", "a.test", QTYPE.A), DNSRecord.question("a.test")) is None
+    assert cache.get(("", "b.test", QTYPE.A), DNSRecord.question("b.test")) is not None
+
+    cache.flush(suffix="corp.test")
+    for name in ("x.corp.test", "corp.test"):
+        assert cache.get(("", name, QTYPE.A), DNSRecord.question(name)) is None
+    # Answers stored after the flush are served again
+    cache.put(("", "x.corp.test", QTYPE.A), answer("x.corp.test"), answer("x.corp.test").pack())
+    assert cache.get(("", "x.corp.test", QTYPE.A), DNSRecord.question("x.corp.test")) is not None
+
+    cache.flush()
+    assert len(cache) == 0 and not cache.flushed_names
+
+
+def test_sharded_cache_flush_nxdomain():
+    cache = ShardedDNSCache({}, shards=4)
+    cache.put(("", "gone.test", QTYPE.A), nxdomain("gone.test"), nxdomain("gone.test").pack())
+    cache.flush(suffix="test")
+    assert cache.get_nxdomain("", "gone.test", DNSRecord.question("gone.test")) is None
+
+
+def test_cache_snapshot_roundtrip(tmp_path):
+    from owldns.cache import load_snapshot, save_snapshot
+    path = str(tmp_path / "cache.json")
+    cache = DNSCache()
+    cache.put(("", "a.test", QTYPE.A), answer("a.test", ttl=300), answer("a.test", ttl=300).pack())
+    cache.put(("", "gone.test", QTYPE.A), nxdomain("gone.test"), nxdomain("gone.test").pack())
+    assert save_snapshot(cache, path) == 2
+
+    # A sharded cache restores it too, including the any-qtype NXDOMAIN marker
+    restored = ShardedDNSCache({}, shards=4)
+    assert load_snapshot(restored, path) == 2
+    assert restored.get(("", "a.test", QTYPE.A), DNSRecord.question("a.test")) is not None
+    assert restored.get_nxdomain("", "gone.test", DNSRecord.question("gone.test", "MX")) is not None
+
+    # Entries whose TTL ran out during the downtime are skipped
+    rows = cache.dump()
+    assert DNSCache().restore(rows, elapsed=120) == 1
+    assert load_snapshot(DNSCache(), str(tmp_path / "missing.json")) == 0
@@ -0,0 +1,52 @@
+from owldns.index import SuffixIndex
+
+
+def test_suffix_index_longest_match():
+    index = SuffixIndex({"example.com": "public", "corp.example.com.": "corp"})
+
+    assert index.match("example.com") == "public"
+    assert index.match("www.example.com") == "public"
+    assert index.match("git.corp.example.com") == "corp"
+    assert index.match("corp.example.com") == "corp"
+    # Suffixes only match on label boundaries
+    assert index.match("badexample.com") is None
+    assert index.match("com", "fallback") == "fallback"
+
+
+def test_suffix_index_add_remove():
+    index = SuffixIndex()
+    index.add("Internal.", 1)
+    assert "internal" in index
+    assert index.match("a.internal") == 1
+    assert index.remove("internal") == 1
+    assert index.match("a.internal") is None
+    assert len(index) == 0
+
+
+def test_record_index_wildcards():
+    from owldns.index import RecordIndex
+    index = RecordIndex({"exact.test": ["10.0.0.1"], "*.wild.test": ["10.0.0.2"],
+                         "*.deep.wild.test": ["10.0.0.3"]})
+    assert index.lookup("exact.test") == ["10.0.0.1"]
+    assert index.lookup("a.exact.test") is None
+    assert index.lookup("wild.test") == ["10.0.0.2"]
+    assert index.lookup("a.b.wild.test") == ["10.0.0.2"]
+    # The most specific wildcard wins
+    assert index.lookup("x.deep.wild.test") == ["10.0.0.3"]
+
+
+def test_record_index_add_remove():
+    from owldns.index import RecordIndex
+    index = RecordIndex()
+    index.add("*.wild.test", "10.0.0.2")
+    index.add("host.test", "10.0.0.1")
+    index.add("host.test", "fd00::1")
+    assert index.lookup("a.wild.test") == ["10.0.0.2"]
+    assert index.lookup("host.test") == ["10.0.0.1", "fd00::1"]
+
+    assert index.remove("host.test", "10.0.0.1")
+    assert index.lookup("host.test") == ["fd00::1"]
+    assert not index.remove("host.test", "10.9.9.9")
+    assert index.remove("*.wild.test")
+    assert index.lookup("a.wild.test") is None
+    assert not index.remove("missing.test")
@@ -0,0 +1,95 @@
+import pytest
+from unittest.mock import patch, AsyncMock
+from dnslib import DNSRecord, RCODE
+from owldns.policy import (NODATA, NXDOMAIN, PASSTHRU, REDIRECT, BloomFilter,
+                           CompactDomainSet, PolicyEngine, parse_rpz)
+from owldns.resolver import Resolver
+
+RPZ_ZONE = """
+$TTL 300
+@       IN SOA localhost. root.localhost. (1 3600 600 86400 60)
+        IN NS  localhost.
+$ORIGIN rpz.local.
+malware.test            CNAME .
+*.tracker.test          CNAME *.
+ok.tracker.test         CNAME rpz-passthru.
+portal.test     300 IN  A     10.0.0.10
+ads.test.rpz.local.     CNAME .
+"""
+
+
+def test_compact_domain_set_with_bloom():
+    entries = {f"host{i}.test": i % 5 + 1 for i in range(1000)}
+    names = CompactDomainSet(entries, bloom=True)
+    assert len(names) == 1000
+    assert all(names.get(name) == code for name, code in entries.items())
+    assert names.get("missing.test") == 0
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(100)
+    keys = [hash(f"k{i}") for i in range(100)]
+    for key in keys:
+        bloom.add(key)
+    assert all(bloom.might_contain(key) for key in keys)
+    assert sum(bloom.might_contain(hash(f"other{i}")) for i in range(1000)) < 100
+
+
+def test_parse_rpz():
+    rules = list(parse_rpz(RPZ_ZONE.splitlines()))
+    assert rules == [
+        ("malware.test", NXDOMAIN, None),
+        ("*.tracker.test", NODATA, None),
+        ("ok.tracker.test", PASSTHRU, None),
+        ("portal.test", REDIRECT, "10.0.0.10"),
+        ("ads.test", NXDOMAIN, None),
+    ]
+
+
+def test_policy_engine_matching(tmp_path):
+    rpz = tmp_path / "policy.rpz"
+    rpz.write_text(RPZ_ZONE)
+    blocklist = tmp_path / "ads.txt"
+    blocklist.write_text("# ads\nadserver.test\nwww.malware.test\n")
+    engine = PolicyEngine({"bloom": True, "sources": [
+        {"file": str(rpz), "format": "rpz"},
+        {"file": str(blocklist)},
+    ]})
+
+    assert engine.match("malware.test") == (NXDOMAIN, None)
+    # RPZ exact triggers do not cover subdomains, but the plain list entry does
+    assert engine.match("a.malware.test") == (0, None)
+    assert engine.match("x.www.malware.test") == (NXDOMAIN, None)
+    # "*.name" covers only names below it; the most specific rule wins
+    assert engine.match("tracker.test") == (0, None)
+    assert engine.match("pixel.tracker.test") == (NODATA, None)
+    assert engine.match("ok.tracker.test") == (PASSTHRU, None)
+    assert engine.match("portal.test") == (REDIRECT, ["10.0.0.10"])
+    assert engine.match("cdn.adserver.test") == (NXDOMAIN, None)
+    assert engine.match("example.com") == (0, None)
+
+
+@pytest.mark.asyncio
+async def test_resolve_applies_policy(tmp_path):
+    hosts = tmp_path / "block.hosts"
+    hosts.write_text("0.0.0.0 ads.test\n0.0.0.0 telemetry.test\n")
+    resolver = Resolver(records={}, upstreams=[{"address": "1.1.1.1", "group": None, "proxy": None}],
+                        policy={"sources": [
+                            {"file": str(hosts), "format": "hosts"},
+                            {"file": str(hosts), "format": "hosts", "action": "redirect",
+                             "redirect": ["10.0.0.1"], "subdomains": False},
+                        ]})
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        # Exact names were overridden by the redirect source
+        response = DNSRecord.parse(await resolver.resolve(DNSRecord.question("ads.test").pack()))
+        assert str(response.rr[0].rdata) == "10.0.0.1"
+        # Redirect without an address of the queried type answers NODATA
+        response = DNSRecord.parse(await resolver.resolve(
+            DNSRecord.question("ads.test", "AAAA").pack()))
+        assert response.header.rcode == RCODE.NOERROR and not response.rr
+        # Subdomains still hit the blocking rule
+        response = DNSRecord.parse(await resolver.resolve(
+            DNSRecord.question("eu.telemetry.test").pack()))
+        assert response.header.rcode == RCODE.NXDOMAIN
+        mock_forward.assert_not_awaited()
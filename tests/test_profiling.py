@@ -0,0 +1,91 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import MagicMock
+from dnslib import DNSRecord
+from owldns.profiling import (BUCKETS, PARSE, SEND, TOTAL,
+                              LatencyHistograms, StackSampler)
+from owldns.resolver import Resolver
+from owldns.server import OwlDNSProtocol
+
+
+def test_histogram_buckets_and_percentiles():
+    hist = LatencyHistograms()
+    for ns in (900, 1000, 1000, 1000, 50_000):
+        hist.record(PARSE, ns)
+    hist.record(PARSE, 10 ** 15)
+
+    buckets = hist.counts[PARSE]
+    assert buckets[(1000).bit_length()] == 4
+    assert buckets[BUCKETS - 1] == 1
+    summary = hist.summary()["parse"]
+    assert summary["count"] == 6
+    assert summary["p50_ns"] == 1024
+    assert summary["p99_ns"] == 1 << (BUCKETS - 1)
+    assert "parse" in hist.format()
+
+    hist.reset()
+    assert hist.summary()["parse"]["count"] == 0
+
+
+def test_histogram_forks_merge_on_read():
+    main = LatencyHistograms()
+    worker = main.fork()
+    main.record(PARSE, 1000)
+    worker.record(PARSE, 1000)
+    worker.record(SEND, 50_000)
+
+    # Each loop writes only its own counts
+    assert sum(main.counts[PARSE]) == 1 and sum(main.counts[SEND]) == 0
+    summary = main.summary()
+    assert summary["parse"]["count"] == 2
+    assert summary["send"]["count"] == 1
+
+    main.reset()
+    assert sum(worker.counts[PARSE]) == 0
+
+
+@pytest.mark.asyncio
+async def test_resolver_records_stages():
+    resolver = Resolver(records={"a.test": ["10.0.0.1"]}, upstreams=[])
+    resolver.profiler = LatencyHistograms()
+
+    await resolver.resolve(DNSRecord.question("a.test").pack())
+    await resolver.resolve(DNSRecord.question("b.test").pack())
+
+    summary = resolver.profiler.summary()
+    assert summary["parse"]["count"] == 2
+    assert summary["local"]["count"] == 2
+    assert summary["forward"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_protocol_records_send_and_total():
+    profiler = LatencyHistograms()
+    resolver = MagicMock()
+    resolver.resolve = MagicMock(return_value=asyncio.sleep(0, b"response"))
+    protocol = OwlDNSProtocol(resolver, profiler)
+    protocol.connection_made(MagicMock())
+
+    await protocol.handle_query(b"query", ("127.0.0.1", 1234))
+    assert sum(profiler.counts[SEND]) == 1
+    assert sum(profiler.counts[TOTAL]) == 1
+
+
+def test_stack_sampler_writes_folded_stacks(tmp_path):
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    try:
+        deadline = time.process_time() + 0.2
+        while time.process_time() < deadline:
+            sum(range(1000))
+    finally:
+        sampler.stop()
+
+    output = tmp_path / "owldns.folded"
+    sampler.write(str(output))
+    lines = output.read_text().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert "test_stack_sampler_writes_folded_stacks" in stack
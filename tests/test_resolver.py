@@ -1,7 +1,7 @@
 import asyncio
 import pytest
 from unittest.mock import patch, AsyncMock
-from dnslib import DNSRecord, QTYPE, RR, A
+from dnslib import DNSRecord, QTYPE, RCODE, RR, A
 from owldns.resolver import Resolver
 
 
@@ -50,7 +50,7 @@ async def test_resolve_forward_to_upstream():
             "google.com").reply().pack()
 
         await resolver.resolve(data)
-        mock_forward.assert_awaited_once_with(data, "1.1.1.1")
+        mock_forward.assert_awaited_once_with(data, "1.1.1.1", timeout=2.0, proxy=None)
 
 
 @pytest.mark.asyncio
@@ -74,7 +74,7 @@ async def test_forward_error_handling():
 async def test_forward_real_logic():
     resolver = Resolver(records={}, upstreams=[
                         {"address": "1.1.1.1", "group": None, "proxy": None}])
-    data = b"query_data"
+    data = DNSRecord.question("Query.Test").pack()
 
     with patch('socket.socket') as mock_sock:
         mock_sock_inst = mock_sock.return_value.__enter__.return_value
@@ -84,21 +84,37 @@ async def test_forward_real_logic():
                 patch.object(loop, 'sock_sendall', new_callable=AsyncMock) as mock_send, \
                 patch.object(loop, 'sock_recv', new_callable=AsyncMock) as mock_recv:
 
-            mock_recv.return_value = b"response_data"
-
-            res = await resolver.forward(data, "1.1.1.1")
-
-            assert res == b"response_data"
+            def respond(sock, size):
+                # Answer the query as sent upstream (random ID), after some bogus packets
+                sent = DNSRecord.parse(mock_send.await_args.args[1])
+                answer = sent.reply()
+                answer.add_answer(RR("query.test", QTYPE.A, rdata=A("10.0.0.1")))
+                spoofed = DNSRecord.question("query.test").reply()
+                spoofed.header.id = sent.header.id
+                return [b"junk", spoofed.pack(), answer.pack()][mock_recv.await_count - 1]
+            mock_recv.side_effect = respond
+
+            res = DNSRecord.parse(await resolver.forward(data, "1.1.1.1"))
+
+            # The client gets its own ID and question back
+            assert res.header.id == DNSRecord.parse(data).header.id
+            assert str(res.q.qname) == "Query.Test."
+            assert str(res.rr[0].rdata) == "10.0.0.1"
             mock_connect.assert_awaited_once()
-            mock_send.assert_awaited_once_with(mock_sock_inst, data)
-            mock_recv.assert_awaited_once_with(mock_sock_inst, 512)
+            # The upstream sees the same question under a fresh ID
+            sent = mock_send.await_args.args[1]
+            assert sent[2:] == data[2:]
+            mock_recv.assert_awaited_with(mock_sock_inst, 512)
+            # The junk packet and the case-mismatched answer were dropped and counted
+            assert mock_recv.await_count == 3
+            assert resolver.health["1.1.1.1"].mismatched == 2
 
 
 @pytest.mark.asyncio
 async def test_forward_timeout():
     resolver = Resolver(records={}, upstreams=[
                         {"address": "1.1.1.1", "group": None, "proxy": None}])
-    data = b"query_data"
+    data = DNSRecord.question("a.test").pack()
 
     with patch('socket.socket'):
         loop = asyncio.get_running_loop()
@@ -112,7 +128,7 @@ async def test_forward_timeout():
 async def test_forward_generic_error():
     resolver = Resolver(records={}, upstreams=[
                         {"address": "1.1.1.1", "group": None, "proxy": None}])
-    data = b"query_data"
+    data = DNSRecord.question("a.test").pack()
 
     with patch('socket.socket'):
         loop = asyncio.get_running_loop()
@@ -158,3 +174,196 @@ async def test_resolve_wildcard_record():
     q3 = DNSRecord.question("wild.test", "A")
     res3 = DNSRecord.parse(await resolver.resolve(q3.pack()))
     assert str(res3.rr[0].rdata) == "10.10.10.10"
+
+
+@pytest.mark.asyncio
+async def test_forward_stream_reuses_pool():
+    resolver = Resolver(records={}, upstreams=[])
+    data = DNSRecord.question("pool.test").pack()
+
+    with patch("owldns.resolver.StreamUpstream.query", new_callable=AsyncMock) as mock_query:
+        mock_query.return_value = b"answer"
+        assert await resolver.forward(data, "tls://1.1.1.1") == b"answer"
+        assert await resolver.forward(data, "tls://1.1.1.1") == b"answer"
+
+    assert list(resolver.streams) == [("tls://1.1.1.1", None)]
+    resolver.close()
+    assert resolver.streams == {}
+
+
+@pytest.mark.asyncio
+async def test_resolve_routes_by_group():
+    resolver = Resolver(records={}, upstreams=[
+        {"address": "10.0.0.53", "group": "corp", "proxy": None},
+        {"address": "1.1.1.1", "group": None, "proxy": None},
+    ], groups={"corp": {"domains": ["corp.example.com"], "timeout": 0.5}})
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = DNSRecord.question("x").reply().pack()
+
+        data = DNSRecord.question("git.corp.example.com").pack()
+        await resolver.resolve(data)
+        mock_forward.assert_awaited_once_with(data, "10.0.0.53", timeout=0.5, proxy=None)
+
+        mock_forward.reset_mock()
+        data = DNSRecord.question("example.com").pack()
+        await resolver.resolve(data)
+        mock_forward.assert_awaited_once_with(data, "1.1.1.1", timeout=2.0, proxy=None)
+
+
+@pytest.mark.asyncio
+async def test_resolve_race_strategy():
+    resolver = Resolver(records={}, upstreams=[
+        {"address": "slow", "group": "g", "proxy": None},
+        {"address": "fast", "group": "g", "proxy": None},
+    ], groups={"g": {"domains": ["race.test"], "strategy": "race"}})
+    answer = DNSRecord.question("race.test").reply().pack()
+
+    async def fake_forward(data, address, timeout, proxy):
+        if address == "slow":
+            await asyncio.sleep(1)
+        return answer
+
+    with patch.object(Resolver, 'forward', side_effect=fake_forward):
+        started = asyncio.get_running_loop().time()
+        assert await resolver.resolve(DNSRecord.question("race.test").pack()) == answer
+        assert asyncio.get_running_loop().time() - started < 0.5
+
+
+def test_resolver_rejects_unknown_strategy():
+    with pytest.raises(ValueError):
+        Resolver(groups={"g": {"strategy": "bogus"}})
+
+
+def test_resolver_rejects_groups_without_upstreams():
+    with pytest.raises(ValueError, match="corp"):
+        Resolver(groups={"corp": {"domains": ["corp.example.com"]}})
+    with pytest.raises(ValueError, match="corp"):
+        Resolver(views=[{"name": "office", "networks": ["10.0.0.0/8"], "group": "corp"}])
+    # Groups without domains are only reachable through views
+    Resolver(groups={"spare": {"strategy": "race"}})
+
+
+@pytest.mark.asyncio
+async def test_resolve_group_without_upstreams_servfails():
+    resolver = Resolver(records={}, upstreams=[{"address": "10.0.0.53", "group": "corp", "proxy": None}],
+                        groups={"corp": {"domains": ["corp.example.com"]}})
+    resolver.upstreams = []
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        response = DNSRecord.parse(await resolver.resolve(DNSRecord.question("git.corp.example.com").pack()))
+        mock_forward.assert_not_awaited()
+    assert response.header.rcode == RCODE.SERVFAIL
+
+
+def test_resolver_clone_shares_state():
+    resolver = Resolver(records={"a.test": ["10.0.0.1"]}, cache={"shards": 4})
+    resolver.streams[("tls://1.1.1.1", None)] = object()
+    twin = resolver.clone()
+
+    assert twin.cache is resolver.cache
+    assert twin.local is resolver.local
+    assert twin.streams == {}
+    # Health counters are per loop, so unsynchronised updates never race
+    twin.upstream_health("1.1.1.1").failure(RuntimeError("timeout"))
+    assert resolver.health == {}
+    assert resolver.merged_health()["1.1.1.1"].failures == 1
+
+
+def upstream_referral_answer(name: str) -> DNSRecord:
+    from dnslib import NS, EDNS0
+    reply = DNSRecord.question(name).reply()
+    reply.add_answer(RR(name, QTYPE.A, rdata=A("10.0.0.1"), ttl=300))
+    reply.add_auth(RR("test", QTYPE.NS, rdata=NS("ns1.test"), ttl=300))
+    reply.add_ar(RR("ns1.test", QTYPE.A, rdata=A("10.0.0.53"), ttl=300))
+    reply.add_ar(EDNS0(udp_len=1232))
+    return reply
+
+
+@pytest.mark.asyncio
+async def test_resolve_minimal_responses():
+    upstream = upstream_referral_answer("min.test").pack()
+    resolver = Resolver(records={}, upstreams=[
+                        {"address": "1.1.1.1", "group": None, "proxy": None}],
+                        minimal_responses=True)
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = upstream
+        first = await resolver.resolve(DNSRecord.question("min.test").pack())
+        cached = await resolver.resolve(DNSRecord.question("min.test").pack())
+
+    for packed in (first, cached):
+        response = DNSRecord.parse(packed)
+        assert len(response.rr) == 1
+        assert response.auth == []
+        assert [rr.rtype for rr in response.ar] == [QTYPE.OPT]
+        assert len(packed) < len(upstream)
+    mock_forward.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_resolve_passes_full_response_by_default():
+    upstream = upstream_referral_answer("full.test").pack()
+    resolver = Resolver(records={}, upstreams=[
+                        {"address": "1.1.1.1", "group": None, "proxy": None}])
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = upstream
+        assert await resolver.resolve(DNSRecord.question("full.test").pack()) == upstream
+
+
+def test_minimize_keeps_negative_soa():
+    from dnslib import SOA, NS
+    reply = DNSRecord.question("none.test").reply()
+    reply.header.rcode = 3
+    reply.add_auth(RR("test", QTYPE.SOA, rdata=SOA("ns1.test", "admin.test", (1, 2, 3, 4, 60))))
+    reply.add_auth(RR("test", QTYPE.NS, rdata=NS("ns1.test")))
+
+    assert Resolver.minimize(reply)
+    assert [rr.rtype for rr in reply.auth] == [QTYPE.SOA]
+    assert not Resolver.minimize(reply)
+
+
+def test_local_answers_use_name_compression():
+    resolver = Resolver(records={"multi.example.test": ["10.0.0.1", "10.0.0.2", "10.0.0.3"]})
+    packed = bytes(resolver.resolve_local(DNSRecord.question("multi.example.test")))
+
+    # Every answer's owner name is a 2-byte pointer to the question name (offset 12)
+    assert packed.count(b"\xc0\x0c") == 3
+    assert packed.count(b"\x05multi") == 1
+
+
+@pytest.mark.asyncio
+async def test_forward_udp_0x20_ignores_spoofed_packets():
+    seen = []
+
+    class Upstream(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            query = DNSRecord.parse(data)
+            seen.append(str(query.q.qname))
+            # A forged answer races ahead of the real one
+            forged = DNSRecord.question(str(query.q.qname).lower()).reply()
+            forged.header.id = query.header.id
+            self.transport.sendto(forged.pack(), addr)
+            self.transport.sendto(b"\x00" * 40, addr)
+            reply = query.reply()
+            reply.add_answer(RR(query.q.qname, QTYPE.A, rdata=A("10.0.0.2")))
+            self.transport.sendto(reply.pack(), addr)
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(Upstream, local_addr=("127.0.0.1", 0))
+    address = "udp://127.0.0.1:%d" % transport.get_extra_info("sockname")[1]
+    resolver = Resolver(records={}, dns0x20=True)
+    try:
+        data = DNSRecord.question("abcdefghijklmnop.example.test").pack()
+        response = DNSRecord.parse(await resolver.forward(data, address))
+        assert str(response.q.qname) == "abcdefghijklmnop.example.test."
+        assert response.header.id == DNSRecord.parse(data).header.id
+        assert str(response.rr[0].rdata) == "10.0.0.2"
+        assert seen[0].lower() == "abcdefghijklmnop.example.test." and seen[0] != seen[0].lower()
+        assert resolver.health[address].mismatched == 2
+    finally:
+        transport.close()
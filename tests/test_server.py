@@ -21,7 +21,7 @@ async def test_protocol_handles_query():
     # Wait for the async task to complete
     await asyncio.sleep(0.1)
 
-    resolver.resolve.assert_awaited_once_with(b"query")
+    resolver.resolve.assert_awaited_once_with(b"query", addr)
     transport.sendto.assert_called_once_with(b"response", addr)
 
 # Helper for AsyncMock since it's only in unittest.mock for 3.8+
@@ -112,3 +112,269 @@ async def test_protocol_handle_query_error():
 
     # Should catch exception and print it (lines 28-29 in server.py)
     await protocol.handle_query(b"data", addr)
+
+
+@pytest.mark.asyncio
+async def test_threaded_server_shares_cache():
+    import socket
+    from unittest.mock import patch
+    from dnslib import RR, A
+    from owldns.profiling import TOTAL
+    from owldns.resolver import Resolver
+
+    reply = DNSRecord.question("threads.test").reply()
+    reply.add_answer(RR("threads.test", rdata=A("10.0.0.7"), ttl=300))
+    server = OwlDNSServer(host="127.0.0.1", port=5356, records={}, threads=3, profile=True)
+
+    def query_many(count):
+        answers = []
+        for _ in range(count):
+            # A fresh source port per query spreads them over the SO_REUSEPORT sockets
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(2.0)
+                sock.sendto(DNSRecord.question("threads.test").pack(), ("127.0.0.1", 5356))
+                answers.append(str(DNSRecord.parse(sock.recv(512)).rr[0].rdata))
+        return answers
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = reply.pack()
+        server_task = asyncio.create_task(server.start())
+        await asyncio.sleep(0.5)
+        try:
+            assert len(server.worker_loops) == 2
+            answers = await asyncio.to_thread(query_many, 30)
+            assert answers == ["10.0.0.7"] * 30
+            # Only the first query went upstream, although several loops answered
+            assert mock_forward.await_count == 1
+            loops = [server.profiler, *server.profiler.forks]
+            assert len(loops) == 3
+            assert sum(1 for hist in loops if sum(hist.counts[TOTAL])) >= 2
+        finally:
+            server_task.cancel()
+            try:
+                await server_task
+            except asyncio.CancelledError:
+                pass
+
+    assert server.workers == [] and server.worker_loops == []
+
+
+@pytest.mark.asyncio
+async def test_protocol_drain_answers_in_flight_queries():
+    import socket
+    resolver = MagicMock()
+
+    async def slow_resolve(data, addr):
+        await asyncio.sleep(0.2 if data == b"slow" else 10)
+        return b"answer"
+    resolver.resolve = slow_resolve
+
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: OwlDNSProtocol(resolver), local_addr=("127.0.0.1", 0))
+    address = transport.get_extra_info("sockname")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(2.0)
+        client.sendto(b"slow", address)
+        client.sendto(b"stuck", address)
+        await asyncio.sleep(0.05)
+
+        # The slow query is answered after the transport stops reading; the stuck one is abandoned
+        assert await protocol.drain(0.5) == 1
+        assert transport.is_closing()
+        assert client.recv(512) == b"answer"
+    assert not protocol.tasks and protocol.reply_socket is None
+
+
+@pytest.mark.asyncio
+async def test_server_stop_saves_cache_snapshot(tmp_path):
+    from owldns.cache import DNSCache
+    from dnslib import RR, QTYPE, A
+    snapshot = str(tmp_path / "cache.json")
+    server = OwlDNSServer(host="127.0.0.1", port=5357, cache={"snapshot": snapshot})
+    reply = DNSRecord.question("kept.test").reply()
+    reply.add_answer(RR("kept.test", QTYPE.A, rdata=A("10.0.0.9"), ttl=300))
+    server.resolver.cache.put(("", "kept.test", QTYPE.A), reply, reply.pack())
+
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.3)
+    server.stop()
+    await asyncio.wait_for(server_task, timeout=5)
+    assert server.transport.is_closing()
+
+    restarted = OwlDNSServer(host="127.0.0.1", port=5357, cache={"snapshot": snapshot})
+    assert isinstance(restarted.resolver.cache, DNSCache)
+    server_task = asyncio.create_task(restarted.start())
+    await asyncio.sleep(0.3)
+    try:
+        assert len(restarted.resolver.cache) == 1
+    finally:
+        server_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await server_task
+
+
+@pytest.mark.asyncio
+async def test_server_handoff(monkeypatch):
+    import os
+    from unittest.mock import patch
+    from owldns.server import LISTEN_FDS_ENV, READY_FD_ENV
+
+    def fake_popen(ready: bytes):
+        def popen(args, env, pass_fds):
+            # Stands in for the new process: it inherits the fds and reports ready
+            assert env[LISTEN_FDS_ENV].split(",")[0] == str(pass_fds[0])
+            if ready:
+                os.write(int(env[READY_FD_ENV]), ready)
+            process = MagicMock(pid=4242)
+            process.poll.return_value = 0
+            return process
+        return popen
+
+    server = OwlDNSServer(host="127.0.0.1", port=5358)
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.3)
+
+    # A successor that exits before serving leaves this process running
+    with patch("owldns.server.subprocess.Popen", side_effect=fake_popen(b"")):
+        assert not await server.handoff()
+    assert not server.transport.is_closing() and not server_task.done()
+
+    # A second request while the successor starts up must not start a rival
+    held = []
+
+    def slow_popen(args, env, pass_fds):
+        held.append(os.dup(int(env[READY_FD_ENV])))
+        return MagicMock(pid=4243)
+
+    with patch("owldns.server.subprocess.Popen", side_effect=slow_popen) as popen:
+        first = asyncio.create_task(server.handoff())
+        await asyncio.sleep(0.1)
+        assert not await server.handoff()
+        assert popen.call_count == 1
+        os.write(held[0], b"1")
+        os.close(held[0])
+        assert await first
+    await asyncio.wait_for(server_task, timeout=5)
+    assert server.handed_off and server.transport.is_closing()
+
+    with patch("owldns.server.subprocess.Popen", side_effect=fake_popen(b"1")) as popen:
+        assert not await server.handoff()
+        popen.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_server_handoff_keeps_admin_when_snapshot_fails(tmp_path):
+    from unittest.mock import patch
+    admin_socket = str(tmp_path / "admin.sock")
+    server = OwlDNSServer(host="127.0.0.1", port=5366, admin={"socket": admin_socket},
+                          cache={"snapshot": str(tmp_path / "missing" / "cache.json")})
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.3)
+    try:
+        with patch("owldns.server.subprocess.Popen") as popen:
+            assert not await server.handoff()
+            popen.assert_not_called()
+        assert server.admin.server is not None and not server.handing_off
+        assert not server_task.done()
+    finally:
+        server.stop()
+        await asyncio.wait_for(server_task, timeout=5)
+
+
+def test_inherited_sockets_and_notify_ready(monkeypatch):
+    import os
+    import socket
+    from owldns.server import LISTEN_FDS_ENV, READY_FD_ENV, inherited_sockets, notify_ready
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    monkeypatch.setenv(LISTEN_FDS_ENV, str(os.dup(sock.fileno())))
+    [inherited] = inherited_sockets()
+    assert inherited.getsockname() == sock.getsockname()
+    assert LISTEN_FDS_ENV not in os.environ
+    inherited.close()
+    sock.close()
+
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setenv(READY_FD_ENV, str(write_fd))
+    notify_ready()
+    assert os.read(read_fd, 1) == b"1"
+    os.close(read_fd)
+    notify_ready()  # No-op without a predecessor
+
+
+@pytest.mark.asyncio
+async def test_dual_stack_listeners_share_cache():
+    import socket
+    from dnslib import RR, QTYPE, A
+    from unittest.mock import patch
+    from owldns.resolver import Resolver
+    server = OwlDNSServer(port=5360, listen=["127.0.0.1", {"address": "[::1]:5360", "rcvbuf": 1 << 20}])
+    assert [(h, p) for h, p, _ in server.listen] == [("127.0.0.1", 5360), ("::1", 5360)]
+
+    reply = DNSRecord.question("dual.test").reply()
+    reply.add_answer(RR("dual.test", QTYPE.A, rdata=A("10.0.0.4"), ttl=300))
+
+    def query(family, address):
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(2.0)
+            sock.sendto(DNSRecord.question("dual.test").pack(), address)
+            return str(DNSRecord.parse(sock.recv(512)).rr[0].rdata)
+
+    with patch.object(Resolver, "forward", new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = reply.pack()
+        server_task = asyncio.create_task(server.start())
+        await asyncio.sleep(0.3)
+        try:
+            assert len(server.transports) == 2
+            assert server.transports[1].get_extra_info("socket").getsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF) >= 1 << 20
+            assert await asyncio.to_thread(query, socket.AF_INET, ("127.0.0.1", 5360)) == "10.0.0.4"
+            assert await asyncio.to_thread(query, socket.AF_INET6, ("::1", 5360)) == "10.0.0.4"
+            # The IPv6 query was answered from the cache filled by the IPv4 one
+            mock_forward.assert_awaited_once()
+        finally:
+            server.stop()
+            await asyncio.wait_for(server_task, timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_ipv6_wildcard_host_stays_dual_stack():
+    import socket
+    server = OwlDNSServer(host="::", port=5361, records={"v4.test": ["10.0.0.9"]}, upstreams=[])
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(0.3)
+
+    def query():
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(2.0)
+            sock.sendto(DNSRecord.question("v4.test").pack(), ("127.0.0.1", 5361))
+            return str(DNSRecord.parse(sock.recv(512)).rr[0].rdata)
+
+    try:
+        assert await asyncio.to_thread(query) == "10.0.0.9"
+    finally:
+        server.stop()
+        await asyncio.wait_for(server_task, timeout=5)
+
+
+def test_ipv6_wildcard_next_to_ipv4_wildcard_is_v6only():
+    server = OwlDNSServer(port=5362, listen=["0.0.0.0", "[::]", "[::]:5363", {"address": "[::1]", "v6only": False}])
+    assert [o.get("v6only") for _, _, o in server.listen] == [None, True, None, False]
+
+
+def test_listen_socket_claims_inherited_by_address():
+    import socket
+    from owldns.server import open_socket
+    server = OwlDNSServer(port=0, listen=["127.0.0.1:5361"])
+    inherited = open_socket(("127.0.0.1", 5361), socket.AF_INET, {})
+    other = open_socket(("127.0.0.1", 0), socket.AF_INET, {"sndbuf": 65536, "freebind": True})
+    server.inherited = [other, inherited]
+    try:
+        assert server.listen_socket(*server.listen[0]) is inherited
+        assert server.inherited == [other]
+    finally:
+        inherited.close()
+        other.close()
@@ -0,0 +1,180 @@
+import asyncio
+import pytest
+from dnslib import DNSRecord, RR, QTYPE, A
+from owldns.upstream import StreamUpstream
+
+
+def make_answer(query: bytes, ip: str) -> bytes:
+    request = DNSRecord.parse(query)
+    reply = request.reply()
+    reply.add_answer(RR(request.q.qname, QTYPE.A, rdata=A(ip)))
+    return bytes(reply.pack())
+
+
+async def start_stub_dns_tcp(connections: list):
+    """A stub DNS-over-TCP server that answers in reverse order of arrival."""
+    async def handle(reader, writer):
+        connections.append(writer)
+        batch = []
+        while True:
+            try:
+                length = int.from_bytes(await reader.readexactly(2), "big")
+                batch.append(await reader.readexactly(length))
+            except asyncio.IncompleteReadError:
+                break
+            if len(batch) == 2:
+                for query in reversed(batch):
+                    answer = make_answer(query, "10.0.0.%d" % len(query))
+                    writer.write(len(answer).to_bytes(2, "big") + answer)
+                batch.clear()
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def start_stub_doh(requests: list):
+    """A stub HTTP/1.1 DoH server answering each POST in order."""
+    async def handle(reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            requests.append(head)
+            length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            answer = make_answer(await reader.readexactly(length), "10.9.9.9")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/dns-message\r\n"
+                         b"Content-Length: %d\r\n\r\n" % len(answer) + answer)
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+@pytest.mark.asyncio
+async def test_stream_upstream_pipelines_out_of_order():
+    connections = []
+    server = await start_stub_dns_tcp(connections)
+    port = server.sockets[0].getsockname()[1]
+    upstream = StreamUpstream("tls", "127.0.0.1", port, pool_size=1, ssl=False)
+
+    try:
+        q1 = DNSRecord.question("a.test").pack()
+        q2 = DNSRecord.question("longer-name.test").pack()
+        r1, r2 = await asyncio.gather(upstream.query(q1), upstream.query(q2))
+
+        # Answers are matched back to their queries and keep the client's ID
+        assert r1[:2] == q1[:2] and r2[:2] == q2[:2]
+        assert str(DNSRecord.parse(r1).q.qname) == "a.test."
+        assert str(DNSRecord.parse(r2).q.qname) == "longer-name.test."
+        # Both queries shared one connection
+        assert len(connections) == 1
+    finally:
+        upstream.close()
+        server.close()
+
+
+@pytest.mark.asyncio
+async def test_stream_upstream_reconnects_after_close():
+    connections = []
+    server = await start_stub_dns_tcp(connections)
+    port = server.sockets[0].getsockname()[1]
+    upstream = StreamUpstream("tls", "127.0.0.1", port, pool_size=1, ssl=False)
+
+    try:
+        q = DNSRecord.question("a.test").pack()
+        await asyncio.gather(upstream.query(q), upstream.query(q))
+        connections[0].close()
+        await asyncio.sleep(0.05)
+        await asyncio.gather(upstream.query(q), upstream.query(q))
+        assert len(connections) == 2
+    finally:
+        upstream.close()
+        server.close()
+
+
+@pytest.mark.asyncio
+async def test_doh_upstream_keepalive():
+    requests = []
+    server = await start_stub_doh(requests)
+    port = server.sockets[0].getsockname()[1]
+    upstream = StreamUpstream("https", "127.0.0.1", port, "/dns-query",
+                              server_name="dns.test", pool_size=1, ssl=False)
+
+    try:
+        queries = [DNSRecord.question(f"q{i}.test").pack() for i in range(3)]
+        answers = await asyncio.gather(*(upstream.query(q) for q in queries))
+
+        for query, answer in zip(queries, answers):
+            record = DNSRecord.parse(answer)
+            assert record.q.qname == DNSRecord.parse(query).q.qname
+            assert str(record.rr[0].rdata) == "10.9.9.9"
+        assert len(requests) == 3
+        assert requests[0].startswith(b"POST /dns-query HTTP/1.1\r\n")
+        assert f"Host: dns.test:{port}".encode() in requests[0]
+    finally:
+        upstream.close()
+        server.close()
+
+
+@pytest.mark.asyncio
+async def test_stream_upstream_timeout():
+    async def silent(reader, writer):
+        await reader.read()
+
+    server = await asyncio.start_server(silent, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    upstream = StreamUpstream("tls", "127.0.0.1", port, ssl=False)
+
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await upstream.query(DNSRecord.question("a.test").pack(), timeout=0.1)
+    finally:
+        upstream.close()
+        server.close()
+
+
+def test_question_matching_helpers():
+    from owldns.upstream import question_section, randomize_case, response_matches
+    query = DNSRecord.question("Mixed-Case1.example.com", "AAAA").pack()
+    question = question_section(query)
+    assert question == query[12:]
+    with pytest.raises(ValueError):
+        question_section(query[:20])
+
+    # 0x20 only flips letter case; digits, hyphens and label lengths are untouched
+    variants = {randomize_case(question) for _ in range(20)}
+    assert len(variants) > 1
+    assert all(v.lower() == question.lower() and v[-4:] == question[-4:] for v in variants)
+
+    reply = DNSRecord.parse(query).reply().pack()
+    assert response_matches(reply, query[:2], question)
+    assert not response_matches(reply, bytes([query[0] ^ 1, query[1]]), question)
+    assert not response_matches(query, query[:2], question)  # QR not set
+    assert not response_matches(reply, query[:2], question.swapcase())
+    assert not response_matches(reply[:14], query[:2], question)
+
+
+@pytest.mark.asyncio
+async def test_stream_connection_drops_mismatched_answer():
+    from owldns.upstream import UpstreamHealth
+
+    async def handle(reader, writer):
+        length = int.from_bytes(await reader.readexactly(2), "big")
+        query = DNSRecord.parse(await reader.readexactly(length))
+        forged = DNSRecord.question("other.test").reply()
+        forged.header.id = query.header.id
+        for answer in (forged.pack(), make_answer(query.pack(), "10.0.0.8")):
+            writer.write(len(answer).to_bytes(2, "big") + answer)
+        await reader.read()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    health = UpstreamHealth()
+    upstream = StreamUpstream("tcp", "127.0.0.1", server.sockets[0].getsockname()[1],
+                              pool_size=1, health=health)
+    try:
+        answer = DNSRecord.parse(await upstream.query(DNSRecord.question("a.test").pack()))
+        assert str(answer.rr[0].rdata) == "10.0.0.8"
+        assert health.mismatched == 1
+    finally:
+        upstream.close()
+        server.close()
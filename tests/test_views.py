@@ -0,0 +1,98 @@
+import pytest
+from unittest.mock import patch, AsyncMock
+from dnslib import DNSRecord, EDNS0, EDNSOption
+from owldns.index import PrefixIndex
+from owldns.resolver import Resolver
+from owldns.views import ViewTable, client_subnet
+
+CORP = [{"address": "10.0.0.53", "group": "corp", "proxy": None}]
+
+VIEWS = [
+    {"name": "office", "networks": ["10.0.0.0/8", "fd00::/8"],
+     "records": {"intranet.test": ["10.0.0.80"]}, "group": "corp"},
+    {"name": "lab", "networks": ["10.9.0.0/16"],
+     "records": {"intranet.test": ["10.9.0.80"]}},
+]
+
+
+def ecs_query(name: str, subnet: bytes, family: int = 1, prefix: int = 24) -> DNSRecord:
+    q = DNSRecord.question(name)
+    q.add_ar(EDNS0(opts=[EDNSOption(8, family.to_bytes(2, "big") + bytes([prefix, 0]) + subnet)]))
+    return q
+
+
+def test_prefix_index_longest_prefix():
+    index = PrefixIndex({"10.0.0.0/8": "a", "10.9.0.0/16": "b", "::/0": "v6"})
+    assert index.match("10.1.2.3") == "a"
+    assert index.match("10.9.2.3") == "b"
+    assert index.match("192.168.1.1") is None
+    assert index.match("2001:db8::1") == "v6"
+    # IPv4-mapped IPv6 clients (dual-stack sockets) match IPv4 networks
+    assert index.match("::ffff:10.9.0.1") == "b"
+    assert len(index) == 3
+
+
+def test_client_subnet_parsing():
+    assert client_subnet(ecs_query("a.test", bytes([10, 9, 1]))) == "10.9.1.0"
+    assert client_subnet(ecs_query("a.test", bytes([0xfd, 0]), family=2, prefix=16)) == "fd00::"
+    assert client_subnet(DNSRecord.question("a.test")) is None
+    # Source prefix 0 opts out of ECS (RFC 7871)
+    assert client_subnet(ecs_query("a.test", b"", prefix=0)) is None
+
+
+def test_view_selection_prefers_trusted_ecs():
+    table = ViewTable(VIEWS, ecs_trusted=["192.168.1.0/24"])
+    plain = DNSRecord.question("a.test")
+    assert table.select(plain, ("10.1.1.1", 5000))["name"] == "office"
+    assert table.select(plain, ("192.168.1.1", 5000)) is None
+    assert table.select(plain, None) is None
+    assert table.select(ecs_query("a.test", bytes([10, 9, 1])), ("192.168.1.1", 5000))["name"] == "lab"
+    # An opted-out ECS option falls back to the packet source
+    assert table.select(ecs_query("a.test", b"", prefix=0), ("10.1.1.1", 5000))["name"] == "office"
+
+    with pytest.raises(ValueError):
+        ViewTable(VIEWS + [{"name": "lab", "networks": []}])
+
+
+@pytest.mark.asyncio
+async def test_resolve_split_horizon_records():
+    resolver = Resolver(records={"intranet.test": ["203.0.113.80"]}, upstreams=CORP, views=VIEWS)
+    data = DNSRecord.question("intranet.test").pack()
+
+    async def answer(addr):
+        return str(DNSRecord.parse(await resolver.resolve(data, addr)).rr[0].rdata)
+
+    assert await answer(("10.1.1.1", 5000)) == "10.0.0.80"
+    assert await answer(("10.9.1.1", 5000)) == "10.9.0.80"
+    assert await answer(("198.51.100.1", 5000)) == "203.0.113.80"
+
+
+def test_view_selection_ignores_untrusted_ecs():
+    table = ViewTable(VIEWS, ecs_trusted=["192.168.1.0/24"])
+    forged = ecs_query("a.test", bytes([10, 9, 1]))
+    assert table.select(forged, ("203.0.113.9", 5000)) is None
+    assert table.select(forged, ("10.1.1.1", 5000))["name"] == "office"
+    # Without trusted sources ECS is never believed
+    assert ViewTable(VIEWS).select(forged, ("203.0.113.9", 5000)) is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_forged_ecs_gets_global_records():
+    resolver = Resolver(records={"intranet.test": ["203.0.113.80"]}, upstreams=CORP, views=VIEWS)
+    data = ecs_query("intranet.test", bytes([10, 0, 0]), prefix=8).pack()
+    response = DNSRecord.parse(await resolver.resolve(data, ("203.0.113.9", 5000)))
+    assert str(response.rr[0].rdata) == "203.0.113.80"
+
+
+@pytest.mark.asyncio
+async def test_resolve_view_selects_group():
+    resolver = Resolver(records={}, upstreams=[
+        {"address": "10.0.0.53", "group": "corp", "proxy": None},
+        {"address": "1.1.1.1", "group": None, "proxy": None},
+    ], views=VIEWS)
+    data = DNSRecord.question("example.com").pack()
+
+    with patch.object(Resolver, 'forward', new_callable=AsyncMock) as mock_forward:
+        mock_forward.return_value = DNSRecord.question("example.com").reply().pack()
+        await resolver.resolve(data, ("10.1.1.1", 5000))
+        mock_forward.assert_awaited_once_with(data, "10.0.0.53", timeout=2.0, proxy=None)